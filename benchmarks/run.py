@@ -0,0 +1,220 @@
+import argparse
+import importlib.util
+import inspect
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+MODELS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "models")
+DEFAULT_BASELINES = os.path.join(BENCHMARKS_DIR, "baselines.json")
+
+# A result regresses when it is slower than its baseline by more than this fraction
+DEFAULT_TOLERANCE = 0.25
+
+
+def import_handler(name):
+    """
+    Import models/<name>/handler.py with runpod.serverless.start turned into a no-op.
+    """
+    import runpod
+    runpod.serverless.start = lambda config: None
+
+    path = os.path.join(MODELS_DIR, name, "handler.py")
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(f"{name}_handler", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_cold(module):
+    # Forget resident models and per-worker caches, as on a freshly started worker
+    from common.lru import LRUCache
+    from common import residency
+    residency._resident_models.clear()
+    for name, value in vars(module).items():
+        if isinstance(value, LRUCache):
+            setattr(module, name, LRUCache(value.max_entries))
+
+
+def run_job(module, job_input, job_id):
+    start = time.perf_counter()
+    output = module.handler({"id": job_id, "input": job_input})
+    if inspect.isgenerator(output):
+        output = list(output)[-1]
+    seconds = time.perf_counter() - start
+    if "error" in output:
+        raise RuntimeError(output["error"])
+    return seconds, output.get("timings", {})
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def median_stages(timings):
+    stages = {}
+    for timing in timings:
+        for stage, seconds in timing.get("stages", {}).items():
+            stages.setdefault(stage, []).append(seconds)
+    return {stage: round(statistics.median(values), 4) for stage, values in stages.items()}
+
+
+def benchmark(name, warm_runs):
+    """
+    Run one handler against moto's in-process S3 and return its results.
+    Sizes run smallest first, so the peak RSS after each size is that size's peak.
+    """
+    import boto3
+    from moto import mock_aws
+    from scenarios import BUCKET, REGION, SCENARIOS
+
+    scenario = SCENARIOS[name]
+    # Handlers write scratch data relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix=f"benchmark_{name}_"))
+
+    with mock_aws():
+        s3 = boto3.client("s3", region_name=REGION)
+        s3.create_bucket(Bucket=BUCKET)
+
+        start = time.perf_counter()
+        module = import_handler(name)
+        import_seconds = time.perf_counter() - start
+        scenario.install(module)
+
+        results = []
+        for size in scenario.sizes:
+            job_input = scenario.job(s3, size)
+
+            make_cold(module)
+            cold_seconds, cold_timings = run_job(module, job_input, f"{name}-{size}-cold")
+
+            warm = [run_job(module, job_input, f"{name}-{size}-warm{i}") for i in range(warm_runs)]
+            warm_seconds = sorted(seconds for seconds, _ in warm)
+            median = statistics.median(warm_seconds)
+            results.append({
+                "size": size,
+                "cold_seconds": round(cold_seconds, 4),
+                "cold_start": cold_timings.get("cold_start", {}),
+                "warm_median_seconds": round(median, 4),
+                "warm_p95_seconds": round(warm_seconds[min(len(warm_seconds) - 1, int(len(warm_seconds) * 0.95))], 4),
+                "jobs_per_second": round(1 / median, 3) if median > 0 else None,
+                "stages": median_stages([timing for _, timing in warm]),
+                "peak_rss_mb": peak_rss_mb(),
+            })
+
+    return {"handler": name, "import_seconds": round(import_seconds, 4), "results": results}
+
+
+def run_isolated(name, warm_runs, python, timeout):
+    """
+    Benchmark a handler in its own interpreter, so imports, resident models and
+    peak RSS do not leak between handlers.
+    """
+    command = [python, os.path.abspath(__file__), "--worker", name, "--warm-runs", str(warm_runs)]
+    env = dict(os.environ, PYTHONPATH=BENCHMARKS_DIR, AWS_ACCESS_KEY_ID="testing",
+               AWS_SECRET_ACCESS_KEY="testing", AWS_DEFAULT_REGION="us-east-1", TIMING_LOG="0",
+               HF_HUB_OFFLINE="1", TRANSFORMERS_OFFLINE="1")
+    try:
+        process = subprocess.run(command, capture_output=True, text=True, env=env, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {"handler": name, "error": f"timed out after {timeout}s"}
+    if process.returncode != 0:
+        return {"handler": name, "error": process.stderr.strip().splitlines()[-1] if process.stderr.strip() else
+                f"exit code {process.returncode}"}
+    # The handlers print progress; the report is the last line
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def compare(report, baselines, tolerance):
+    """
+    Return the (handler, size, metric, baseline, current) rows slower than baseline.
+    """
+    regressions = []
+    for name, current in report.items():
+        baseline = baselines.get(name)
+        if not baseline or "results" not in current or "results" not in baseline:
+            continue
+        baseline_sizes = {result["size"]: result for result in baseline["results"]}
+        for result in current["results"]:
+            reference = baseline_sizes.get(result["size"])
+            if reference is None:
+                continue
+            for metric in ("cold_seconds", "warm_median_seconds", "peak_rss_mb"):
+                if result[metric] > reference[metric] * (1 + tolerance):
+                    regressions.append((name, result["size"], metric, reference[metric], result[metric]))
+    return regressions
+
+
+def print_report(report):
+    print(f"{'handler':28} {'size':>6} {'cold s':>9} {'warm s':>9} {'p95 s':>9} {'jobs/s':>8} {'rss MB':>8}")
+    for name, current in report.items():
+        if "error" in current:
+            print(f"{name:28} skipped: {current['error']}")
+            continue
+        for result in current["results"]:
+            print(f"{name:28} {result['size']:>6} {result['cold_seconds']:>9.3f} {result['warm_median_seconds']:>9.3f} "
+                  f"{result['warm_p95_seconds']:>9.3f} {result['jobs_per_second'] or 0:>8.2f} {result['peak_rss_mb']:>8.1f}")
+
+
+def main():
+    from scenarios import SCENARIOS
+
+    parser = argparse.ArgumentParser(description="Benchmark the handlers offline against local S3 and stub models.")
+    parser.add_argument("handlers", nargs="*", help="Handlers to run (default: all)")
+    parser.add_argument("--warm-runs", type=int, default=5)
+    parser.add_argument("--python", default=sys.executable,
+                        help="Interpreter with the handler's requirements installed")
+    parser.add_argument("--timeout", type=int, default=1800, help="Seconds allowed per handler")
+    parser.add_argument("--baselines", default=DEFAULT_BASELINES)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--update-baselines", action="store_true", help="Store this run as the new baselines")
+    parser.add_argument("--output", help="Also write the full report to this JSON file")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(benchmark(args.worker, args.warm_runs)))
+        return 0
+
+    unknown = [name for name in args.handlers if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown handlers: {', '.join(unknown)}")
+
+    report = {}
+    for name in args.handlers or SCENARIOS:
+        print(f"Benchmarking {name}...", file=sys.stderr)
+        report[name] = run_isolated(name, args.warm_runs, args.python, args.timeout)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+
+    if args.update_baselines:
+        baselines.update({name: current for name, current in report.items() if "error" not in current})
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Baselines written to {args.baselines}")
+        return 0
+
+    regressions = compare(report, baselines, args.tolerance)
+    for name, size, metric, reference, value in regressions:
+        print(f"REGRESSION {name} size {size}: {metric} {value} vs baseline {reference}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+import io
+import os
+
+import cv2
+import numpy as np
+import soundfile as sf
+from PIL import Image
+
+import stubs
+
+BUCKET = "benchmark"
+REGION = "us-east-1"
+
+
+def base_input(**fields):
+    # Every run does the full work: the result cache is bypassed
+    return dict(bucket_name=BUCKET, aws_access_key_id="testing", aws_secret_access_key="testing",
+                aws_region=REGION, use_cache=False, **fields)
+
+
+def image_bytes(width, height, fmt="PNG"):
+    # A smooth gradient with noise, so encoders and decoders do realistic work
+    rng = np.random.default_rng(width * height)
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.stack([x * 255 // max(1, width - 1), y * 255 // max(1, height - 1),
+                      (x + y) * 255 // max(1, width + height - 2)], axis=-1).astype(np.int16)
+    image += rng.integers(-16, 16, image.shape, dtype=np.int16)
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def put_image(s3, key, width, height):
+    s3.put_object(Bucket=BUCKET, Key=key, Body=image_bytes(width, height))
+    return key
+
+
+def put_video(s3, key, width, height, seconds, fps=25):
+    path = f"/tmp/benchmark_{width}x{height}_{seconds}s.mp4"
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    frame = cv2.imdecode(np.frombuffer(image_bytes(width, height), np.uint8), cv2.IMREAD_COLOR)
+    for i in range(int(seconds * fps)):
+        writer.write(np.roll(frame, i * 4, axis=1))
+    writer.release()
+    s3.upload_file(path, BUCKET, key)
+    os.remove(path)
+    return key
+
+
+def put_audio(s3, key, seconds, sample_rate=16000):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    buffer = io.BytesIO()
+    sf.write(buffer, (0.2 * np.sin(2 * np.pi * 180 * t)).astype(np.float32), sample_rate, format="WAV")
+    s3.put_object(Bucket=BUCKET, Key=key, Body=buffer.getvalue())
+    return key
+
+
+class Scenario:
+    """
+    How to benchmark one handler: `install` swaps its models for stand-ins,
+    `job` uploads the inputs for one size and returns the job input.
+    """
+
+    sizes = ()
+
+    def install(self, module):
+        raise NotImplementedError
+
+    def job(self, s3, size):
+        raise NotImplementedError
+
+
+class CaricatureToRealImage(Scenario):
+    sizes = (256, 512, 1024)
+
+    def install(self, module):
+        module.load_pipeline = stubs.ImagePipeline
+
+    def job(self, s3, size):
+        return base_input(input_key=put_image(s3, f"in/{size}.png", size, size), output_key=f"out/{size}.png")
+
+
+class CaricatureToRealImageNew(CaricatureToRealImage):
+    def install(self, module):
+        module.load_pipeline = lambda: (stubs.PidiNet(), stubs.ImagePipeline())
+
+
+class Pix2PixImageInpainting(CaricatureToRealImage):
+    def job(self, s3, size):
+        return dict(super().job(s3, size), hf_prompt="make it snow")
+
+
+class ImageToVideo(CaricatureToRealImage):
+    # Video width; the height keeps SVD's 16:9 and both are passed on, since the plan
+    # would otherwise pick the same size for every input
+
+    def install(self, module):
+        module.load_pipeline = stubs.VideoPipeline
+
+    def job(self, s3, size):
+        height = size * 9 // 16 // 8 * 8
+        return base_input(input_key=put_image(s3, f"in/{size}.png", size, size), output_key=f"out/{size}.mp4",
+                          width=size, height=height)
+
+
+class GfpganUpscalingImage(Scenario):
+    # The largest size gets a memory budget below its upscaled size, so it runs the tiled path
+    sizes = (256, 1024, 2048, 3072)
+    TILED_FROM = 3072
+    TILED_MEMORY_BUDGET_MB = 1024
+
+    def install(self, module):
+        module.load_enhancer = stubs.Enhancer
+
+    def job(self, s3, size):
+        job_input = base_input(input_key=put_image(s3, f"in/{size}.png", size, size), output_key=f"out/{size}.png")
+        if size >= self.TILED_FROM:
+            job_input["memory_budget_mb"] = self.TILED_MEMORY_BUDGET_MB
+        return job_input
+
+
+class DentroFaceswap(Scenario):
+    sizes = (256, 512, 1024)
+
+    def install(self, module):
+        module.load_models = lambda: (stubs.FaceAnalysis(), stubs.Swapper())
+
+    def job(self, s3, size):
+        return base_input(source_key=put_image(s3, "in/source.png", 512, 512),
+                          destination_key=put_image(s3, f"in/{size}.png", size, size),
+                          output_key=f"out/{size}.png", source_face_index=1, destination_face_index=1)
+
+
+class LipSyncWav2Lip(Scenario):
+    # Frame side of a two second clip
+    sizes = (128, 256, 512)
+
+    def install(self, module):
+        module.load_model = stubs.wav2lip
+        module.load_detector = lambda device: stubs.FaceDetector()
+
+    def job(self, s3, size):
+        return base_input(video_input_key=put_video(s3, f"in/{size}.mp4", size, size, 2),
+                          audio_input_key=put_audio(s3, "in/audio.wav", 2),
+                          output_key=f"out/{size}.mp4")
+
+
+class CoquiXTTSv2(Scenario):
+    # Sentences of text
+    sizes = (1, 4, 16)
+
+    def install(self, module):
+        module.load_tts = lambda device: stubs.TTS()
+
+    def job(self, s3, size):
+        text = " ".join(["The quick brown fox jumps over the lazy dog."] * size)
+        return base_input(text=text, language="en", output_key=f"out/{size}.wav")
+
+
+class FluxImageGeneration(Scenario):
+    # Prompts per job
+    sizes = (1, 4, 8)
+
+    def install(self, module):
+        module.session = stubs.InferenceSession()
+
+    def job(self, s3, size):
+        if size == 1:
+            return base_input(hf_auth_token="testing", hf_prompt="a lighthouse at dusk", output_key="out/1.png")
+        return base_input(hf_auth_token="testing", hf_prompts=[f"a lighthouse at dusk, take {i}" for i in range(size)],
+                          output_keys=[f"out/{size}_{i}.png" for i in range(size)])
+
+
+SCENARIOS = {
+    "caricatureToRealImage": CaricatureToRealImage(),
+    "caricatureToRealImage_new": CaricatureToRealImageNew(),
+    "pix2pixImageInpainting": Pix2PixImageInpainting(),
+    "imageToVideo": ImageToVideo(),
+    "gfpganUpscalingImage": GfpganUpscalingImage(),
+    "dentro_faceswap": DentroFaceswap(),
+    "lipSync_Wav2Lip": LipSyncWav2Lip(),
+    "coquiXTTSv2": CoquiXTTSv2(),
+    "fluxImageGeneration": FluxImageGeneration(),
+}
@@ -0,0 +1,213 @@
+import io
+from collections import defaultdict
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Tiny CPU stand-ins with the interfaces the handlers call. They do a little
+# real work on the data (resize, blur, copy) so the benchmark still measures
+# every stage around the model: transfers, decode, pre/post-processing,
+# encode and upload.
+
+
+class ImagePipeline:
+    """
+    Diffusers text/image-to-image pipeline: returns the conditioning image.
+    """
+
+    def __call__(self, prompt=None, image=None, num_images_per_prompt=1, **kwargs):
+        return SimpleNamespace(images=[image.convert("RGB")] * num_images_per_prompt)
+
+    def encode_prompt(self, prompt=None, **kwargs):
+        return None, None, None, None
+
+
+class PidiNet:
+    def __call__(self, image, detect_resolution=512, image_resolution=512, apply_filter=False):
+        return image.convert("RGB").resize((image_resolution, image_resolution))
+
+
+class VideoPipeline:
+    """
+    Stable Video Diffusion: repeats the conditioning image as every frame.
+    Its "latents" are the frames themselves, scaled to [-1, 1].
+    """
+
+    def __call__(self, image, num_frames=25, height=None, width=None, output_type="pil", **kwargs):
+        if height and width:
+            image = image.resize((width, height))
+        if output_type != "latent":
+            return SimpleNamespace(frames=[[image] * num_frames])
+        import torch
+        frame = torch.from_numpy(np.asarray(image.convert("RGB"))).permute(2, 0, 1).float() / 127.5 - 1
+        return SimpleNamespace(frames=frame.expand(1, num_frames, *frame.shape))
+
+    def decode_latents(self, latents, num_frames, decode_chunk_size=14):
+        # (batch, frames, channels, h, w) to (batch, channels, frames, h, w)
+        return latents.permute(0, 2, 1, 3, 4)
+
+
+class FaceHelper:
+    """
+    facexlib FaceRestoreHelper that finds no faces and only upscales.
+    """
+
+    def __init__(self, upscale):
+        self.upscale = upscale
+        self.clean_all()
+
+    def clean_all(self):
+        self.input_img = None
+        self.det_faces = []
+        self.all_landmarks_5 = []
+        self.cropped_faces = []
+        self.affine_matrices = []
+        self.restored_faces = []
+
+    def read_image(self, image):
+        self.input_img = image
+
+    def get_face_landmarks_5(self, **kwargs):
+        return 0
+
+    def align_warp_face(self):
+        pass
+
+    def add_restored_face(self, face):
+        self.restored_faces.append(face)
+
+    def get_inverse_affine(self, save_inverse_affine_path=None):
+        pass
+
+    def paste_faces_to_input_image(self, upsample_img=None):
+        height, width = self.input_img.shape[:2]
+        return cv2.resize(self.input_img, (width * self.upscale, height * self.upscale),
+                          interpolation=cv2.INTER_LINEAR)
+
+
+class Enhancer:
+    """
+    GFPGANer: upscales without restoring any face.
+    """
+
+    def __init__(self, upscale=2):
+        self.upscale = upscale
+        self.device = "cpu"
+        self.face_helper = FaceHelper(upscale)
+
+    def enhance(self, image, has_aligned=False, only_center_face=False, paste_back=True, **kwargs):
+        self.face_helper.clean_all()
+        self.face_helper.read_image(image)
+        return [], [], self.face_helper.paste_faces_to_input_image()
+
+
+def _face(width, height):
+    from insightface.app.common import Face
+    bbox = np.array([width * 0.35, height * 0.3, width * 0.65, height * 0.7], dtype=np.float32)
+    kps = np.array([[0.43, 0.43], [0.57, 0.43], [0.5, 0.52], [0.45, 0.6], [0.55, 0.6]], dtype=np.float32)
+    # normed_embedding is derived from embedding by insightface
+    embedding = np.ones(512, dtype=np.float32) / np.sqrt(512)
+    return Face(bbox=bbox, kps=kps * [width, height], det_score=0.99, embedding=embedding)
+
+
+class FaceAnalysis:
+    """
+    insightface FaceAnalysis that always finds one face in the middle of the image.
+    """
+
+    def get(self, image):
+        height, width = image.shape[:2]
+        return [_face(width, height)]
+
+
+class Swapper:
+    """
+    inswapper: blurs the target face box in place of swapping it.
+    """
+
+    def get(self, image, target_face, source_face, paste_back=True):
+        x1, y1, x2, y2 = [int(v) for v in target_face.bbox]
+        result = image.copy()
+        if x2 > x1 and y2 > y1:
+            result[y1:y2, x1:x2] = cv2.GaussianBlur(result[y1:y2, x1:x2], (9, 9), 0)
+        return result
+
+
+class FaceDetector:
+    """
+    Wav2Lip's S3FD FaceAlignment: one face box in the middle of every frame.
+    """
+
+    def get_detections_for_batch(self, images):
+        height, width = images.shape[1:3]
+        return [(width // 4, height // 4, width * 3 // 4, height * 3 // 4)] * len(images)
+
+
+def wav2lip():
+    """
+    Wav2Lip network: returns the unmasked reference face of each sample.
+    """
+    import torch
+
+    class Wav2Lip(torch.nn.Module):
+        def forward(self, mels, faces):
+            return faces[:, 3:]
+
+    return Wav2Lip().eval()
+
+
+class Xtts:
+    """
+    XTTS model behind TTS.api.TTS: a short tone per character of text.
+    """
+
+    SAMPLES_PER_CHAR = 1200
+
+    def __init__(self):
+        self.config = SimpleNamespace(audio=SimpleNamespace(output_sample_rate=24000), gpt_cond_len=30,
+                                      gpt_cond_chunk_len=4, max_ref_len=30, sound_norm_refs=False, temperature=0.75,
+                                      length_penalty=1.0, repetition_penalty=5.0, top_k=50, top_p=0.85)
+        self.tokenizer = SimpleNamespace(char_limits=defaultdict(lambda: 250))
+
+    def parameters(self):
+        import torch
+        return iter([torch.zeros(1)])
+
+    def get_conditioning_latents(self, audio_path=None, **kwargs):
+        import torch
+        return torch.zeros(1, 32, 1024), torch.zeros(1, 512, 1)
+
+    def _wav(self, text):
+        t = np.arange(len(text) * self.SAMPLES_PER_CHAR) / self.config.audio.output_sample_rate
+        return (0.1 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+
+    def inference(self, text, language, gpt_cond_latent, speaker_embedding, **kwargs):
+        return {"wav": self._wav(text)}
+
+
+class TTS:
+    def __init__(self, model_name=None, **kwargs):
+        self.synthesizer = SimpleNamespace(tts_model=Xtts())
+
+    def to(self, device):
+        return self
+
+    def tts(self, text, language=None, **kwargs):
+        return self.synthesizer.tts_model._wav(text)
+
+
+class InferenceSession:
+    """
+    requests.Session posting to the inference API: answers with a fixed PNG.
+    """
+
+    def __init__(self, width=1024, height=1024):
+        image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8))
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        self.content = buffer.getvalue()
+
+    def post(self, url, headers=None, json=None, timeout=None):
+        return SimpleNamespace(content=self.content, raise_for_status=lambda: None)
@@ -148,7 +148,9 @@ function checkStatus(requestId, apiKey) {
     }, 5000);
 }
 
-function displayResult(outputUrl) {
+function displayResult(output) {
+    // Handle both string and object response formats
+    const outputUrl = typeof output === 'string' ? output : output.image_url;
     const resultDiv = document.getElementById('result');
     resultDiv.innerHTML = `<p>Processing completed. <a href="${outputUrl}" target="_blank">Click here</a> to view the output image.</p>`;
     document.getElementById('inputForm').style.display = ''; // Show the form again
@@ -3,13 +3,39 @@ import numpy as np
 from PIL import Image
 from diffusers import StableDiffusionControlNetPipeline, ControlNetModel, UniPCMultistepScheduler
 import torch
-import boto3
 import io
 import os
+import sys
 import runpod
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.assets import ModelAssets
+from common.encode import image_format, upload_image
+from common.concurrency import async_handler, concurrency_modifier, inference_slot
+from common.residency import model_state
+from common.result_cache import check_result_cache, store_result
+from common.s3 import get_s3_client
+from common.timing import Timings
+
+# Weights listed in assets.json, baked into the image at build time
+assets = ModelAssets(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Load ControlNet and Stable Diffusion pipeline
+def load_pipeline():
+    controlnet = ControlNetModel.from_pretrained(assets.repo("lllyasviel/sd-controlnet-canny"),
+                                                 torch_dtype=torch.float16)
+    pipe = StableDiffusionControlNetPipeline.from_pretrained(assets.repo("stabilityai/stable-diffusion-2"),
+                                                             controlnet=controlnet, safety_checker=None,
+                                                             torch_dtype=torch.float16)
+    pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
+    pipe.enable_model_cpu_offload()
+    return pipe
+
+
 def handler(job):
     job_input = job["input"]  # Access the input from the request.
+    timings = Timings(job, "caricatureToRealImage")
     bucket_name = job_input["bucket_name"]
     input_key = job_input["input_key"]
     output_key = job_input["output_key"]
@@ -17,56 +43,61 @@ def handler(job):
     aws_secret_access_key = job_input["aws_secret_access_key"]
     aws_region = job_input["aws_region"]
     endpoint = job_input.get("endpoint", None)  # Optional custom endpoint URL
+    output_format = image_format(job_input)  # Optional output_format / output_quality, PNG by default
 
-    # Set AWS credentials and region
-    os.environ['AWS_ACCESS_KEY_ID'] = aws_access_key_id
-    os.environ['AWS_SECRET_ACCESS_KEY'] = aws_secret_access_key
-    os.environ['AWS_DEFAULT_REGION'] = aws_region
+    # Reuse a pooled S3 client for these credentials and endpoint
+    s3 = get_s3_client(aws_access_key_id, aws_secret_access_key, aws_region, endpoint)
 
-    # Initialize S3 client with a custom endpoint if provided
-    s3 = boto3.client('s3', endpoint_url=endpoint)
+    # Answer repeated work from the result cache without loading any model
+    with timings.span("cache_lookup"):
+        cache_key, cached_url = check_result_cache(s3, job_input, output_key, "caricatureToRealImage", "lllyasviel/sd-controlnet-canny")
+    if cached_url is not None:
+        return {"image_url": cached_url, "cache_hit": True, "timings": timings.report()}
 
     # Load the image from S3
-    response = s3.get_object(Bucket=bucket_name, Key=input_key)
-    image_data = response['Body'].read()
-    image = Image.open(io.BytesIO(image_data))
-    image = np.array(image)
-
-    # Convert image to grayscale if necessary
-    if image.ndim == 3 and image.shape[2] == 3:
-        image_gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-    else:
-        image_gray = image
-
-    # Apply Canny edge detection
-    low_threshold = 100
-    high_threshold = 200
-    edges = cv2.Canny(image_gray, low_threshold, high_threshold)
-    edges = np.stack([edges] * 3, axis=-1)
-
-    # Convert edges to PIL image
-    image_pil = Image.fromarray(edges)
-
-    # Load ControlNet and Stable Diffusion pipeline
-    controlnet = ControlNetModel.from_pretrained("lllyasviel/sd-controlnet-canny", torch_dtype=torch.float16)
-    pipe = StableDiffusionControlNetPipeline.from_pretrained("stabilityai/stable-diffusion-2", controlnet=controlnet,
-                                                             safety_checker=None, torch_dtype=torch.float16)
-    pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
-    pipe.enable_model_cpu_offload()
+    with timings.span("s3_download"):
+        response = s3.get_object(Bucket=bucket_name, Key=input_key)
+        image_data = response['Body'].read()
+    with timings.span("decode"):
+        image = Image.open(io.BytesIO(image_data))
+        image = np.array(image)
+
+    with timings.span("preprocess"):
+        # Convert image to grayscale if necessary
+        if image.ndim == 3 and image.shape[2] == 3:
+            image_gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        else:
+            image_gray = image
+
+        # Apply Canny edge detection
+        low_threshold = 100
+        high_threshold = 200
+        edges = cv2.Canny(image_gray, low_threshold, high_threshold)
+        edges = np.stack([edges] * 3, axis=-1)
+
+        # Convert edges to PIL image
+        image_pil = Image.fromarray(edges)
 
-    # Generate output image
-    output_image = pipe("bird", image_pil, num_inference_steps=20).images[0]
+    # Reuse the pipeline kept by this worker, loading it on the first job only
+    pipe, warm = timings.load_resident("controlnet-canny-sd2", load_pipeline)
+
+    # Generate output image, one job at a time on the pipeline
+    with inference_slot("controlnet-canny-sd2"), timings.span("inference"):
+        output_image = pipe("bird", image_pil, num_inference_steps=20).images[0]
 
     # Save the output image back to S3
-    buffer = io.BytesIO()
-    output_image.save(buffer, format="PNG")
-    buffer.seek(0)
-    s3.put_object(Bucket=bucket_name, Key=output_key, Body=buffer, ContentType='image/png')
-
-    # Return presigned URL for the output image
-    response = s3.generate_presigned_url('get_object',
-                                         Params={'Bucket': bucket_name,
-                                                 'Key': output_key}, ExpiresIn=3600)
-    return response
-
-runpod.serverless.start({"handler": handler})  # Required.
+    response, encoded = upload_image(s3, bucket_name, output_key, output_image, output_format, timings)
+    store_result(s3, cache_key, bucket_name, output_key)
+
+    return {
+        "image_url": response,
+        "model_state": model_state(warm),
+        "cache_hit": False,
+        "encoding": encoded,
+        "timings": timings.report()
+    }
+
+# Several jobs run at once so S3 transfers and encoding overlap with inference.
+# Not when imported by the diffusersMultiTask worker, which serves this handler among others.
+if __name__ == "__main__":
+    runpod.serverless.start({"handler": async_handler(handler), "concurrency_modifier": concurrency_modifier})  # Required.
@@ -1,5 +1,28 @@
 import boto3
 import os
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.assets import ModelAssets
+from common.encode import image_format, upload_image
+from common.concurrency import async_handler, concurrency_modifier, inference_slot
+from common.residency import model_state
+from common.result_cache import check_result_cache, store_result
+from common.s3 import get_s3_client
+from common.timing import Timings
+from common.video import chunked
+
+# Weights listed in assets.json, baked into the image at build time
+assets = ModelAssets(os.path.dirname(os.path.abspath(__file__)))
+
+MODEL_NAME = "t2i-adapter-sketch-sdxl"
+
+# Variants generated by one pipeline call; more are generated in several calls. The size is
+# fixed, not derived from free memory: lower VARIANT_BATCH_SIZE (or "batch_size") on smaller GPUs
+DEFAULT_VARIANT_BATCH_SIZE = int(os.environ.get("VARIANT_BATCH_SIZE", 4))
+UPLOAD_WORKERS = 4
 
 try:
     import io
@@ -14,34 +37,119 @@ except ImportError as e:
     print(f"ImportError: {e}")
 
 
+# Load PidiNet, the sketch T2I-Adapter and the Stable Diffusion XL pipeline
+def load_pipeline():
+    pidinet = PidiNetDetector.from_pretrained(assets.repo("lllyasviel/Annotators")).to("cuda")
+
+    # Load T2I-Adapter for sketches
+    adapter = T2IAdapter.from_pretrained(
+        assets.repo("TencentARC/t2i-adapter-sketch-sdxl-1.0"), torch_dtype=torch.float16, varient="fp16"
+    ).to("cuda")
+
+    # Load Stable Diffusion XL model and scheduler
+    model_id = assets.repo('stabilityai/stable-diffusion-xl-base-1.0')
+    euler_a = EulerAncestralDiscreteScheduler.from_pretrained(model_id, subfolder="scheduler")
+    vae = AutoencoderKL.from_pretrained(assets.repo("madebyollin/sdxl-vae-fp16-fix"), torch_dtype=torch.float16)
+
+    pipe = StableDiffusionXLAdapterPipeline.from_pretrained(
+        model_id, vae=vae, adapter=adapter, scheduler=euler_a, torch_dtype=torch.float16, variant="fp16"
+    ).to("cuda")
+    pipe.enable_xformers_memory_efficient_attention()
+    return pidinet, pipe
+
+
+# Seeds of the variants asked for with "seeds" or "num_variants" (counting up from "seed"),
+# or None for a single image
+def variant_seeds(job_input):
+    if "seeds" in job_input:
+        seeds = [int(seed) for seed in job_input["seeds"]]
+        if "num_variants" in job_input and int(job_input["num_variants"]) != len(seeds):
+            raise ValueError("num_variants and the length of seeds must match")
+        return seeds
+    if "num_variants" in job_input:
+        seed = int(job_input.get("seed", random.randrange(2 ** 31)))
+        return [seed + i for i in range(int(job_input["num_variants"]))]
+    return None
+
+
+# Output keys of the variants: "output_keys", or output_key with the variant index before the extension
+def variant_output_keys(job_input, count):
+    if "output_keys" in job_input:
+        output_keys = job_input["output_keys"]
+        if len(output_keys) != count:
+            raise ValueError("output_keys must have one key per variant")
+        return output_keys
+    if "output_key" not in job_input:
+        raise ValueError("Either output_key or output_keys must be provided")
+    root, ext = os.path.splitext(job_input["output_key"])
+    return [f"{root}_{i}{ext}" for i in range(count)]
+
+
+# Generate one image per seed in a single pipeline call. The sketch goes through the adapter
+# once for the whole batch, and the prompt embeddings are the ones encoded once for the job.
+def generate_batch(pipe, image_sketch, embeddings, seeds):
+    prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds = embeddings
+    generator = None
+    if seeds[0] is not None:
+        generator = [torch.Generator("cuda").manual_seed(seed) for seed in seeds]
+    return pipe(
+        prompt_embeds=prompt_embeds,
+        negative_prompt_embeds=negative_prompt_embeds,
+        pooled_prompt_embeds=pooled_prompt_embeds,
+        negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+        image=image_sketch,
+        num_images_per_prompt=len(seeds),
+        num_inference_steps=30,
+        adapter_conditioning_scale=0.9,
+        guidance_scale=7.5,
+        generator=generator,
+    ).images
+
+
 def handler(job):
     try:
         job_input = job["input"]  # Access input from the request.
+        timings = Timings(job, "caricatureToRealImage_new")
         bucket_name = job_input["bucket_name"]
         input_key = job_input["input_key"]
-        output_key = job_input["output_key"]
         aws_access_key_id = job_input["aws_access_key_id"]
         aws_secret_access_key = job_input["aws_secret_access_key"]
         aws_region = job_input["aws_region"]
         endpoint = job_input.get("endpoint", None)  # Optional custom endpoint URL
+        output_format = image_format(job_input)  # Optional output_format / output_quality, PNG by default
         prompt = job_input.get("prompt", "4k photo, highly detailed")
         negativePrompt = job_input.get("negativePrompt", 
                                        "extra digit, fewer digits, cropped, worst quality, low quality, "
                                        "glitch, deformed, mutated, ugly, disfigured")
 
-        # Set AWS credentials and region
-        os.environ['AWS_ACCESS_KEY_ID'] = aws_access_key_id
-        os.environ['AWS_SECRET_ACCESS_KEY'] = aws_secret_access_key
-        os.environ['AWS_DEFAULT_REGION'] = aws_region
+        # Several variants of one sketch with "num_variants" and/or "seeds", generated in batches
+        seeds = variant_seeds(job_input)
+        single_variant = seeds is None
+        if single_variant:
+            seeds = [int(job_input["seed"]) if "seed" in job_input else None]
+            output_keys = [job_input["output_key"]]
+        else:
+            output_keys = variant_output_keys(job_input, len(seeds))
+        batch_size = max(1, int(job_input.get("batch_size", DEFAULT_VARIANT_BATCH_SIZE)))
+
+        # Reuse a pooled S3 client for these credentials and endpoint
+        s3 = get_s3_client(aws_access_key_id, aws_secret_access_key, aws_region, endpoint)
 
-        # Initialize S3 client with a custom endpoint if provided
-        s3 = boto3.client('s3', endpoint_url=endpoint)
+        # Answer repeated single-image work from the result cache without loading any model
+        cache_key = None
+        if single_variant:
+            with timings.span("cache_lookup"):
+                cache_key, cached_url = check_result_cache(s3, job_input, output_keys[0], "caricatureToRealImage_new", "TencentARC/t2i-adapter-sketch-sdxl-1.0")
+            if cached_url is not None:
+                return {"image_url": cached_url, "cache_hit": True, "timings": timings.report()}
 
         # Download image from S3
-        response = s3.get_object(Bucket=bucket_name, Key=input_key)
-        image_data = response['Body'].read()
-        image = Image.open(io.BytesIO(image_data))
-        image = np.array(image)
+        with timings.span("s3_download"):
+            response = s3.get_object(Bucket=bucket_name, Key=input_key)
+            image_data = response['Body'].read()
+        with timings.span("decode"):
+            image = Image.open(io.BytesIO(image_data))
+            image = np.array(image)
 
     except KeyError as e:
         print(f"Missing key in input: {e}")
@@ -59,25 +167,15 @@ def handler(job):
         image_gray = image
 
     try:
-        # Use PidiNet for edge detection (instead of Canny)
-        pidinet = PidiNetDetector.from_pretrained("lllyasviel/Annotators").to("cuda")
-        image_pil = Image.fromarray(image_gray)
-        image_sketch = pidinet(image_pil, detect_resolution=1024, image_resolution=1024, apply_filter=True)
-
-        # Load T2I-Adapter for sketches
-        adapter = T2IAdapter.from_pretrained(
-            "TencentARC/t2i-adapter-sketch-sdxl-1.0", torch_dtype=torch.float16, varient="fp16"
-        ).to("cuda")
-
-        # Load Stable Diffusion XL model and scheduler
-        model_id = 'stabilityai/stable-diffusion-xl-base-1.0'
-        euler_a = EulerAncestralDiscreteScheduler.from_pretrained(model_id, subfolder="scheduler")
-        vae = AutoencoderKL.from_pretrained("madebyollin/sdxl-vae-fp16-fix", torch_dtype=torch.float16)
+        # Reuse the models kept by this worker, loading them on the first job only
+        (pidinet, pipe), warm = timings.load_resident(MODEL_NAME, load_pipeline)
 
-        pipe = StableDiffusionXLAdapterPipeline.from_pretrained(
-            model_id, vae=vae, adapter=adapter, scheduler=euler_a, torch_dtype=torch.float16, variant="fp16"
-        ).to("cuda")
-        pipe.enable_xformers_memory_efficient_attention()
+        # Use PidiNet for edge detection (instead of Canny), and encode the prompts, once for all variants
+        image_pil = Image.fromarray(image_gray)
+        with inference_slot(MODEL_NAME), timings.span("preprocess"):
+            image_sketch = pidinet(image_pil, detect_resolution=1024, image_resolution=1024, apply_filter=True)
+            embeddings = pipe.encode_prompt(prompt=prompt, device="cuda", num_images_per_prompt=1,
+                                            do_classifier_free_guidance=True, negative_prompt=negativePrompt)
 
     except torch.cuda.CudaError as e:
         print(f"CUDA error: {e}")
@@ -88,41 +186,63 @@ def handler(job):
     except Exception as e:
         print(f"An error occurred: {e}")
 
+    # Generate the variants batch by batch; each batch is encoded and uploaded on the upload
+    # pool while the next one is generated, and other jobs can use the pipeline in between
+    uploads = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+    pending = []
+    failure = None
     try:
-        gen_images = pipe(
-            prompt=prompt,
-            negative_prompt=negativePrompt,
-            image=image_sketch,
-            num_inference_steps=30,
-            adapter_conditioning_scale=0.9,
-            guidance_scale=7.5,
-        ).images[0]
+        for batch in chunked(list(zip(seeds, output_keys)), batch_size):
+            with inference_slot(MODEL_NAME), timings.span("inference"):
+                gen_images = generate_batch(pipe, image_sketch, embeddings, [seed for seed, _ in batch])
+            for (seed, variant_key), gen_image in zip(batch, gen_images):
+                pending.append((seed, variant_key, uploads.submit(upload_image, s3, bucket_name, variant_key,
+                                                                  gen_image, output_format, timings)))
 
     except torch.cuda.CudaError as e:
-        print(f"CUDA error during image generation: {e}")
+        failure = f"CUDA error during image generation: {e}"
+        print(failure)
     except ValueError as e:
-        print(f"Value error during inference: {e}")
+        failure = f"Value error during inference: {e}"
+        print(failure)
     except RuntimeError as e:
-        print(f"Runtime error during Stable Diffusion inference: {e}")
+        failure = f"Runtime error during Stable Diffusion inference: {e}"
+        print(failure)
     except Exception as e:
-        print(f"An unexpected error occurred during image generation: {e}")
+        failure = f"An unexpected error occurred during image generation: {e}"
+        print(failure)
 
-    # Save the generated image back to S3
+    # Wait for the generated images to be saved back to S3
     try:
-        # Save the generated image to a BytesIO buffer
-        buffer = io.BytesIO()
-        gen_images.save(buffer, format="PNG")
-        buffer.seek(0)
+        images = []
+        for seed, variant_key, upload in pending:
+            response, encoded = upload.result()
+            images.append({"seed": seed, "output_key": variant_key, "image_url": response, "encoding": encoded})
+
+        # A failed batch stops generation; the variants already uploaded are still reported
+        if failure is not None:
+            return {
+                "error": failure,
+                "missing_seeds": seeds[len(images):],
+                "images": images,
+                "timings": timings.report()
+            }
 
-        # Upload the image to S3
-        s3.put_object(Bucket=bucket_name, Key=output_key, Body=buffer, ContentType='image/png')
+        if not single_variant:
+            return {
+                "images": images,
+                "model_state": model_state(warm),
+                "timings": timings.report()
+            }
 
-        # Generate and return a presigned URL for the uploaded image
-        response = s3.generate_presigned_url('get_object',
-                                             Params={'Bucket': bucket_name,
-                                                     'Key': output_key},
-                                             ExpiresIn=3600)
-        return response
+        store_result(s3, cache_key, bucket_name, output_keys[0])
+        return {
+            "image_url": images[0]["image_url"],
+            "model_state": model_state(warm),
+            "cache_hit": False,
+            "encoding": images[0]["encoding"],
+            "timings": timings.report()
+        }
 
     except boto3.exceptions.S3UploadFailedError as e:
         print(f"S3 upload failed: {e}")
@@ -132,6 +252,11 @@ def handler(job):
         print(f"IO error while saving the image or interacting with S3: {e}")
     except Exception as e:
         print(f"An unexpected error occurred during image upload or URL generation: {e}")
+    finally:
+        uploads.shutdown()
 
 
-runpod.serverless.start({"handler": handler})
+# Several jobs run at once so S3 transfers and encoding overlap with inference.
+# Not when imported by the diffusersMultiTask worker, which serves this handler among others.
+if __name__ == "__main__":
+    runpod.serverless.start({"handler": async_handler(handler), "concurrency_modifier": concurrency_modifier})
@@ -0,0 +1,4 @@
+# Helpers shared by the handlers in ./models.
+#
+# The Dockerfiles copy the whole repository into the image, so every handler
+# can reach this package through its parent directory.
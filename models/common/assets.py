@@ -0,0 +1,258 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import urllib.request
+import zipfile
+
+# Every handler lists its weights in an assets.json next to handler.py:
+#
+#   "files": single files, fetched from "url". A zip with "unpack": "zip" becomes
+#            a directory; a torch checkpoint with "convert": "safetensors" is
+#            stored as safetensors ("state_dict_key" picks the weights out of it,
+#            "strip_prefix" is removed from the start of their names).
+#   "repos": Hugging Face repos, limited to "allow_patterns" and stored under "path".
+#
+# Paths are relative to the handler directory. "sha256" (files) and "checksums"
+# (directories, per file) pin the stored form and are written by --pin. An asset
+# without them is only reported, unless REQUIRE_PINNED_ASSETS=1 is set to make
+# verification fail on it once every manifest is pinned.
+#
+# The Dockerfiles run this module at build time, so workers start with every
+# asset on local disk. With MODEL_MIRROR_DIR set, assets are copied from
+# <mirror>/<handler>/<path> instead of downloaded.
+MANIFEST_NAME = "assets.json"
+MIRROR_DIR = os.environ.get("MODEL_MIRROR_DIR")
+
+# Re-hash assets when a worker loads them, not only when they are fetched
+VERIFY_ON_LOAD = os.environ.get("VERIFY_MODEL_ASSETS", "0") == "1"
+
+REQUIRE_PINNED = os.environ.get("REQUIRE_PINNED_ASSETS", "0") == "1"
+
+_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tree_checksums(path):
+    # Download bookkeeping of huggingface_hub is not part of the asset
+    checksums = {}
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if d != ".cache"]
+        for name in files:
+            file_path = os.path.join(root, name)
+            checksums[os.path.relpath(file_path, path)] = sha256_file(file_path)
+    return dict(sorted(checksums.items()))
+
+
+def checksums_of(path):
+    return sha256_file(path) if os.path.isfile(path) else tree_checksums(path)
+
+
+def load_state_dict(path, device="cpu"):
+    """
+    Load model weights, memory-mapped when the format allows it so only the
+    pages that are used get read: safetensors first, then torch checkpoints
+    with mmap (torch >= 2.1), then a plain torch.load.
+    """
+    if path.endswith(".safetensors"):
+        from safetensors.torch import load_file
+        return load_file(path, device=device)
+    import torch
+    try:
+        return torch.load(path, map_location=device, mmap=True, weights_only=False)
+    except (TypeError, RuntimeError):
+        # Older torch, or a checkpoint in the legacy (non-zip) format
+        return torch.load(path, map_location=device)
+
+
+def _copy(source, target):
+    if os.path.isdir(source):
+        shutil.copytree(source, target)
+    else:
+        shutil.copyfile(source, target)
+
+
+def _download(url, path):
+    print(f"Downloading {url}...")
+    with urllib.request.urlopen(url) as response, open(path, "wb") as f:
+        shutil.copyfileobj(response, f, _BLOCK_SIZE)
+
+
+def _convert_to_safetensors(source, target, state_dict_key=None, strip_prefix=None):
+    import torch
+    from safetensors.torch import save_file
+    checkpoint = torch.load(source, map_location="cpu")
+    state_dict = checkpoint[state_dict_key] if state_dict_key else checkpoint
+    # Checkpoints saved from a DataParallel model carry "module." before every name
+    if strip_prefix:
+        state_dict = {name[len(strip_prefix):] if name.startswith(strip_prefix) else name: tensor
+                      for name, tensor in state_dict.items()}
+    save_file({name: tensor.contiguous() for name, tensor in state_dict.items()}, target)
+
+
+class ModelAssets:
+    """
+    The assets of one handler, resolved to local paths.
+
+    Workers normally find every asset baked into the image. A missing file
+    is fetched (and verified) on first use, and a missing repo falls back to
+    its hub id, so images built without assets keep working, only slower.
+    """
+
+    def __init__(self, handler_dir, mirror_dir=MIRROR_DIR):
+        self.handler_dir = handler_dir
+        self.name = os.path.basename(os.path.normpath(handler_dir))
+        self.mirror_dir = mirror_dir
+        self.manifest_path = os.path.join(handler_dir, MANIFEST_NAME)
+        with open(self.manifest_path) as f:
+            self.manifest = json.load(f)
+        self.files = {asset["path"]: asset for asset in self.manifest.get("files", [])}
+        self.repos = {repo["repo_id"]: repo for repo in self.manifest.get("repos", [])}
+
+    def _local(self, path):
+        return os.path.join(self.handler_dir, path)
+
+    def _mirrored(self, path):
+        if self.mirror_dir:
+            source = os.path.join(self.mirror_dir, self.name, path)
+            if os.path.exists(source):
+                return source
+        return None
+
+    def path(self, path):
+        """
+        Local path of a file asset.
+        """
+        asset = self.files[path]
+        target = self._local(path)
+        if not os.path.exists(target):
+            print(f"Asset {path} is not in the image, fetching it now")
+            self.fetch_file(asset)
+        elif VERIFY_ON_LOAD:
+            self.verify(asset)
+        return target
+
+    def repo(self, repo_id):
+        """
+        Local directory of a repo asset, for from_pretrained. Falls back to the
+        mirror, then to the hub id itself.
+        """
+        repo = self.repos[repo_id]
+        target = self._local(repo["path"])
+        if os.path.isdir(target):
+            if VERIFY_ON_LOAD:
+                self.verify(repo)
+            return target
+        mirrored = self._mirrored(repo["path"])
+        if mirrored is not None:
+            return mirrored
+        print(f"Asset {repo_id} is not in the image, loading it from the hub")
+        return repo_id
+
+    def verify(self, asset):
+        target = self._local(asset["path"])
+        expected = asset.get("sha256") or asset.get("checksums")
+        if expected is None:
+            if REQUIRE_PINNED:
+                raise ValueError(f"Asset {asset['path']} has no pinned checksum, run assets.py --pin to add one")
+            print(f"Asset {asset['path']} has no pinned checksum, run assets.py --pin to add one")
+            return
+        if checksums_of(target) != expected:
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            else:
+                os.remove(target)
+            raise ValueError(f"Checksum mismatch for asset {asset['path']}, removed it")
+
+    def fetch_file(self, asset, verify=True):
+        target = self._local(asset["path"])
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+
+        # Build in a scratch directory next to the target, then move it in place
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(target) or ".") as tmpdir:
+            staged = os.path.join(tmpdir, "staged")
+            source = self._mirrored(asset["path"])
+            if source is not None:
+                _copy(source, staged)
+            else:
+                downloaded = os.path.join(tmpdir, "download")
+                _download(asset["url"], downloaded)
+                if asset.get("unpack") == "zip":
+                    with zipfile.ZipFile(downloaded) as archive:
+                        archive.extractall(staged)
+                elif asset.get("convert") == "safetensors":
+                    _convert_to_safetensors(downloaded, staged, asset.get("state_dict_key"),
+                                            asset.get("strip_prefix"))
+                else:
+                    os.rename(downloaded, staged)
+            os.rename(staged, target)
+        if verify:
+            self.verify(asset)
+
+    def fetch_repo(self, repo, verify=True):
+        target = self._local(repo["path"])
+        source = self._mirrored(repo["path"])
+        if source is not None:
+            _copy(source, target)
+        else:
+            from huggingface_hub import snapshot_download
+            print(f"Downloading {repo['repo_id']}...")
+            snapshot_download(repo["repo_id"], revision=repo.get("revision"),
+                              allow_patterns=repo.get("allow_patterns"), local_dir=target,
+                              local_dir_use_symlinks=False)
+        if verify:
+            self.verify(repo)
+
+    def fetch_all(self, verify=True):
+        for asset in self.files.values():
+            if not os.path.exists(self._local(asset["path"])):
+                self.fetch_file(asset, verify)
+            elif verify:
+                self.verify(asset)
+        for repo in self.repos.values():
+            if not os.path.isdir(self._local(repo["path"])):
+                self.fetch_repo(repo, verify)
+            elif verify:
+                self.verify(repo)
+
+    def pin(self):
+        """
+        Record the checksums of the fetched assets in the manifest.
+        """
+        for asset in self.manifest.get("files", []):
+            key = "sha256" if os.path.isfile(self._local(asset["path"])) else "checksums"
+            asset[key] = checksums_of(self._local(asset["path"]))
+        for repo in self.manifest.get("repos", []):
+            repo["checksums"] = checksums_of(self._local(repo["path"]))
+        with open(self.manifest_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+            f.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch and verify the model assets of a handler.")
+    parser.add_argument("handler_dir", nargs="?", default=".")
+    parser.add_argument("--mirror", default=MIRROR_DIR, help="Copy assets from this mirror directory")
+    parser.add_argument("--pin", action="store_true", help="Write the checksums of the fetched assets")
+    args = parser.parse_args()
+
+    assets = ModelAssets(os.path.abspath(args.handler_dir), args.mirror or None)
+    # Pinning fetches without verifying, then records what was fetched
+    assets.fetch_all(verify=not args.pin)
+    if args.pin:
+        assets.pin()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
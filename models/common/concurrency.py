@@ -0,0 +1,40 @@
+import asyncio
+import os
+import threading
+
+# Jobs a worker runs at the same time. With more than one, the next job's
+# download and decode and the previous job's encode and upload overlap with
+# the current job's inference.
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", 2))
+
+# Jobs allowed to use one model at the same time; 1 keeps inference serialized
+INFERENCE_SLOTS = int(os.environ.get("INFERENCE_SLOTS", 1))
+
+_slots = {}
+_slots_lock = threading.Lock()
+
+
+def concurrency_modifier(current_concurrency):
+    return JOB_CONCURRENCY
+
+
+def async_handler(handler):
+    """
+    Wrap a blocking handler so the worker can run several jobs concurrently,
+    each on its own thread.
+    """
+    async def run(job):
+        return await asyncio.to_thread(handler, job)
+    return run
+
+
+def inference_slot(name):
+    """
+    Semaphore guarding every use of the model registered under `name`.
+    Use it as `with inference_slot(name):` around inference and any other
+    step that touches the model's state.
+    """
+    with _slots_lock:
+        if name not in _slots:
+            _slots[name] = threading.Semaphore(INFERENCE_SLOTS)
+        return _slots[name]
@@ -0,0 +1,139 @@
+import io
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Output formats a job can pick with "output_format". "output_quality" is the
+# zlib level (0-9) for PNG and the quality (1-100) for WebP and JPEG.
+ImageFormat = namedtuple("ImageFormat", ["name", "content_type", "quality"])
+
+FORMATS = {
+    "png": ("PNG", "image/png", 6),
+    "webp": ("WEBP", "image/webp", 90),
+    "jpeg": ("JPEG", "image/jpeg", 92),
+}
+FORMAT_ALIASES = {"jpg": "jpeg"}
+DEFAULT_FORMAT = "png"
+
+
+def image_format(job_input, default=DEFAULT_FORMAT):
+    """
+    Read the output format and quality of a job, PNG at level 6 by default.
+    """
+    name = str(job_input.get("output_format", default)).lower()
+    name = FORMAT_ALIASES.get(name, name)
+    if name not in FORMATS:
+        raise ValueError(f"Unsupported output_format {name}, expected one of: {', '.join(FORMATS)}")
+    _, content_type, quality = FORMATS[name]
+    quality = int(job_input.get("output_quality", quality))
+    if name == "png" and not 0 <= quality <= 9:
+        raise ValueError("output_quality must be a compression level between 0 and 9 for png")
+    if name != "png" and not 1 <= quality <= 100:
+        raise ValueError(f"output_quality must be between 1 and 100 for {name}")
+    return ImageFormat(name, content_type, quality)
+
+
+def encode_image(image, image_format):
+    """
+    Encode a PIL image or an RGB uint8 array. Returns (data, info) where info
+    holds the format, the encoded size and the encode time for the job output.
+    """
+    start = time.perf_counter()
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    buffer = io.BytesIO()
+    pil_format = FORMATS[image_format.name][0]
+    if image_format.name == "png":
+        image.save(buffer, format=pil_format, compress_level=image_format.quality)
+    elif image_format.name == "webp":
+        image.save(buffer, format=pil_format, quality=image_format.quality, method=4)
+    else:
+        image.save(buffer, format=pil_format, quality=image_format.quality)
+    data = buffer.getvalue()
+
+    info = {
+        "format": image_format.name,
+        "bytes": len(data),
+        "encode_seconds": round(time.perf_counter() - start, 4),
+    }
+    return data, info
+
+
+def upload_image(s3, bucket_name, key, image, image_format, timings):
+    """
+    Encode an image in the job's output format, upload it and return its
+    presigned URL and encoding info. Encoding runs on the calling thread:
+    batch jobs call this on their upload pool, so it overlaps with inference
+    on the next item there.
+    """
+    data, info = encode_image(image, image_format)
+    timings.add("encode", info["encode_seconds"])
+    with timings.span("s3_upload"):
+        s3.put_object(Bucket=bucket_name, Key=key, Body=data, ContentType=image_format.content_type)
+    with timings.span("presign"):
+        url = s3.generate_presigned_url('get_object', Params={'Bucket': bucket_name, 'Key': key}, ExpiresIn=3600)
+    return url, info
+
+
+class PNGWriter:
+    """
+    Write an 8-bit RGB PNG to a file object a band of rows at a time, so large
+    images are never held in memory as a whole, neither raw nor encoded.
+    """
+
+    def __init__(self, fileobj, width, height, compress_level=6, chunk_size=1024 * 1024):
+        self.fileobj = fileobj
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.chunk_size = chunk_size
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = []
+        self._pending_size = 0
+
+        fileobj.write(_PNG_SIGNATURE)
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, chunk_type, data):
+        self.fileobj.write(struct.pack('>I', len(data)))
+        self.fileobj.write(chunk_type)
+        self.fileobj.write(data)
+        self.fileobj.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    def _flush(self):
+        if self._pending:
+            self._chunk(b'IDAT', b''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def write_rows(self, rows):
+        """
+        Append rows given as a uint8 array of shape (n, width, 3).
+        """
+        if rows.shape[1:] != (self.width, 3):
+            raise ValueError(f"Expected rows of shape (n, {self.width}, 3), got {rows.shape}")
+        for row in rows:
+            # Filter type 0 (none) for every scanline
+            data = self._compressor.compress(b'\x00' + row.tobytes())
+            if data:
+                self._pending.append(data)
+                self._pending_size += len(data)
+        self.rows_written += rows.shape[0]
+        if self._pending_size >= self.chunk_size:
+            self._flush()
+
+    def close(self):
+        if self.rows_written != self.height:
+            raise ValueError(f"PNG declared {self.height} rows but {self.rows_written} were written")
+        self._pending.append(self._compressor.flush())
+        self._flush()
+        self._chunk(b'IEND', b'')
@@ -0,0 +1,349 @@
+import gc
+import hashlib
+import itertools
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Models loaded by this worker process, keyed by name, least recently used first.
+# Without budgets, entries live for the whole lifetime of the worker so warm jobs
+# skip weight loading entirely.
+_resident_models = OrderedDict()
+_load_locks = {}
+_registry_lock = threading.Lock()
+
+# Budgets for workers hosting several models, in MB (0 disables a budget). Over the
+# device budget the least recently used models are moved to host RAM, over the host
+# budget the least recently used models are dropped. Models used by a running job
+# (see job_scope) and models that manage their own CPU offloading are never moved.
+MB = 1024 * 1024
+DEVICE_BUDGET_MB = int(os.environ.get("MODEL_DEVICE_BUDGET_MB", 0))
+HOST_BUDGET_MB = int(os.environ.get("MODEL_HOST_BUDGET_MB", 0))
+
+# Pipeline components that are shared between models when their weights are identical
+SHARED_COMPONENTS = ("text_encoder", "text_encoder_2", "vae")
+
+_budget_lock = threading.RLock()
+_offloaded = set()
+_pins = {}
+_scope = threading.local()
+_stats = {"loads": 0, "hits": 0, "restores": 0, "offloads": 0, "evictions": 0, "shared_components": 0}
+# Device bytes each model took when last loaded, to make room before it is loaded again
+_footprints = {}
+
+# Loaded shareable components by (class, parameter names, shapes and dtypes), and their content digests
+_shareable = {}
+_digests = weakref.WeakKeyDictionary()
+
+
+def _lock_for(name):
+    with _registry_lock:
+        if name not in _load_locks:
+            _load_locks[name] = threading.Lock()
+        return _load_locks[name]
+
+
+def load_resident(name, loader):
+    """
+    Return (model, warm) for the model registered under `name`.
+
+    `loader` is called without arguments the first time the name is requested
+    and its result is kept for every following job. `warm` is False only for
+    the job that paid for the load. A model that the device budget moved to
+    host RAM is moved back to the device first.
+    """
+    # Only one thread loads a given model, the others wait for it
+    with _lock_for(name):
+        with _budget_lock:
+            model = _resident_models.get(name)
+            warm = model is not None
+            if warm:
+                _stats["hits"] += 1
+                if name in _offloaded:
+                    # Room is made on the device before the weights move back
+                    _make_room(_memory("cpu", [name]), exclude=name)
+                    _restore(name)
+                _pin(name)
+                with _registry_lock:
+                    _resident_models.move_to_end(name)
+            else:
+                # The loader moves the weights to the device itself, so room is made first.
+                # A model seen before needs its last footprint, a new one the largest known.
+                _make_room(_footprints.get(name, max(_footprints.values(), default=0)))
+        if not warm:
+            print(f"Loading {name}...")
+            start = time.perf_counter()
+            model = loader()
+            with _budget_lock:
+                _share_components(name, model)
+                with _registry_lock:
+                    _resident_models[name] = model
+                _offloaded.discard(name)
+                if DEVICE_BUDGET_MB or HOST_BUDGET_MB:
+                    _footprints[name] = _memory(device_type(), [name])
+                _stats["loads"] += 1
+                _pin(name)
+            print(f"Model {name} loaded in {time.perf_counter() - start:.1f}s")
+    _enforce_budgets()
+    return model, warm
+
+
+def device_type():
+    """
+    Device the models of this worker run on: "cuda" when a GPU is available.
+    """
+    torch = _torch()
+    return "cuda" if torch is not None and torch.cuda.is_available() else "cpu"
+
+
+def _torch():
+    # Handlers without torch (onnxruntime models) have no torch memory to account for
+    try:
+        import torch
+    except ImportError:
+        return None
+    return torch
+
+
+def available_memory():
+    """
+    Memory the host can still hand out, from /proc/meminfo, or None where it
+    cannot be read.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def model_state(warm):
+    """
+    Value reported in the job output to tell warm and cold jobs apart.
+    """
+    return "warm" if warm else "cold"
+
+
+@contextmanager
+def job_scope():
+    """
+    Keep every model the current thread loads with load_resident pinned until
+    the block exits, so budget enforcement triggered by other jobs never moves
+    a model out from under the running job.
+    """
+    _scope.names = []
+    try:
+        yield
+    finally:
+        with _budget_lock:
+            for name in _scope.names:
+                _pins[name] -= 1
+                if not _pins[name]:
+                    del _pins[name]
+        _scope.names = None
+        _enforce_budgets()
+
+
+def _pin(name):
+    names = getattr(_scope, "names", None)
+    if names is not None:
+        names.append(name)
+        _pins[name] = _pins.get(name, 0) + 1
+
+
+def _modules(model):
+    """
+    torch modules making up a model: the components of a diffusers pipeline,
+    the members of a tuple, or the module attributes of any other object.
+    """
+    torch = _torch()
+    if torch is None:
+        return []
+    if isinstance(model, torch.nn.Module):
+        return [model]
+    if isinstance(model, (tuple, list)):
+        return [module for part in model for module in _modules(part)]
+    parts = getattr(model, "components", None)
+    if not isinstance(parts, dict):
+        parts = vars(model) if hasattr(model, "__dict__") else {}
+    return [part for part in parts.values() if isinstance(part, torch.nn.Module)]
+
+
+def _module_bytes(module, device_type):
+    tensors = itertools.chain(module.parameters(), module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors if t.device.type == device_type)
+
+
+def _unique_modules(names):
+    modules = {}
+    for name in names:
+        for module in _modules(_resident_models[name]):
+            modules[id(module)] = module
+    return modules.values()
+
+
+def _memory(device_type, names=None):
+    return sum(_module_bytes(module, device_type)
+               for module in _unique_modules(_resident_models if names is None else names))
+
+
+def _self_offloading(model):
+    # Pipelines with enable_model_cpu_offload / enable_sequential_cpu_offload carry accelerate hooks
+    return any(hasattr(module, "_hf_hook") for module in _modules(model))
+
+
+def _offload(name):
+    # Components shared with a model that stays on the device stay there too
+    staying = {id(module) for other in _resident_models if other != name and other not in _offloaded
+               for module in _modules(_resident_models[other])}
+    for module in _modules(_resident_models[name]):
+        if id(module) not in staying:
+            module.to("cpu")
+    _offloaded.add(name)
+    _stats["offloads"] += 1
+    print(f"Model {name} moved to host memory")
+
+
+def _restore(name):
+    start = time.perf_counter()
+    for module in _modules(_resident_models[name]):
+        module.to(device_type())
+    _offloaded.discard(name)
+    _stats["restores"] += 1
+    print(f"Model {name} moved back to the device in {time.perf_counter() - start:.1f}s")
+
+
+def _device_budget():
+    # Without a GPU there is no device memory to budget separately from host RAM
+    return DEVICE_BUDGET_MB * MB if DEVICE_BUDGET_MB and device_type() == "cuda" else 0
+
+
+def _offload_until(limit, candidates):
+    offloaded = False
+    for name in candidates:
+        if _memory(device_type()) <= limit:
+            break
+        if name in _pins or name in _offloaded or _self_offloading(_resident_models[name]):
+            continue
+        _offload(name)
+        offloaded = True
+    return offloaded
+
+
+def _make_room(needed, exclude=None):
+    """
+    Move least recently used models to host RAM until `needed` more bytes fit
+    in the device budget.
+    """
+    if not _device_budget():
+        return
+    if _offload_until(_device_budget() - needed, [name for name in _resident_models if name != exclude]):
+        _release_memory()
+
+
+def _release_memory():
+    torch = _torch()
+    gc.collect()
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _enforce_budgets():
+    if not DEVICE_BUDGET_MB and not HOST_BUDGET_MB:
+        return
+    with _budget_lock:
+        changed = False
+        # Least recently used first; the most recently used model always stays
+        candidates = list(_resident_models)[:-1]
+        if _device_budget():
+            changed = _offload_until(_device_budget(), candidates)
+        for name in candidates:
+            if not HOST_BUDGET_MB or _memory("cpu") <= HOST_BUDGET_MB * MB:
+                break
+            # Dropping a model frees host RAM only if it holds some: offloaded models
+            # and models kept on the CPU. Warm models on the device stay.
+            if name in _pins or not _memory("cpu", [name]):
+                continue
+            with _registry_lock:
+                del _resident_models[name]
+            _offloaded.discard(name)
+            _stats["evictions"] += 1
+            changed = True
+            print(f"Model {name} evicted")
+        if changed:
+            _release_memory()
+
+
+def _signature(module):
+    return (type(module).__name__,) + tuple((key, tuple(t.shape), str(t.dtype))
+                                            for key, t in module.state_dict().items())
+
+
+def _digest(module):
+    if module not in _digests:
+        import torch
+        digest = hashlib.sha256()
+        for key, tensor in sorted(module.state_dict().items()):
+            digest.update(key.encode())
+            digest.update(tensor.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes())
+        _digests[module] = digest.hexdigest()
+    return _digests[module]
+
+
+def _share_components(name, model):
+    """
+    Swap the text encoders and VAE of a newly loaded pipeline for identical
+    ones another model already holds on the same device. Weights are hashed
+    only when an earlier component has the same layout, so single-model
+    workers pay nothing.
+    """
+    if isinstance(model, (tuple, list)):
+        for part in model:
+            _share_components(name, part)
+        return
+    components = getattr(model, "components", None)
+    if not isinstance(components, dict) or _self_offloading(model):
+        return
+    for key in SHARED_COMPONENTS:
+        module = components.get(key)
+        if module is None or not hasattr(module, "state_dict"):
+            continue
+        signature = _signature(module)
+        device = next(module.parameters()).device
+        candidates = [ref() for ref in _shareable.get(signature, [])]
+        match = next((other for other in candidates if other is not None and other is not module
+                      and next(other.parameters()).device == device and _digest(other) == _digest(module)), None)
+        if match is not None:
+            model.register_modules(**{key: match})
+            _stats["shared_components"] += 1
+            print(f"Model {name} shares its {key} with an already loaded model")
+        else:
+            _shareable.setdefault(signature, []).append(weakref.ref(module))
+
+
+def residency_stats():
+    """
+    Which models this worker holds and where, with load, offload and eviction counters.
+    """
+    with _budget_lock:
+        names = list(_resident_models)
+        return {
+            "models": [{
+                "name": name,
+                "placement": "host" if name in _offloaded else "device",
+                "device_mb": round(_memory("cuda", [name]) / MB),
+                "host_mb": round(_memory("cpu", [name]) / MB),
+                "pinned": name in _pins,
+            } for name in reversed(names)],
+            "device_mb": round(_memory("cuda") / MB),
+            "host_mb": round(_memory("cpu") / MB),
+            "device_budget_mb": DEVICE_BUDGET_MB or None,
+            "host_budget_mb": HOST_BUDGET_MB or None,
+            **_stats,
+        }
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import quote, unquote
+
+from common.lru import LRUCache
+
+# Results kept per worker, and how long a result may be reused
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 1024))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 24 * 3600))
+
+# With a prefix set (e.g. "result-cache/"), every cached result also gets an empty
+# index object under it in the job's bucket, named after the cache key, so cold
+# workers and the other workers of the endpoint find it too. Unset, the index stays
+# in worker memory and nothing is written to the bucket besides the job's outputs.
+RESULT_CACHE_PREFIX = os.environ.get("RESULT_CACHE_PREFIX", "")
+
+# Job fields that never change the result: credentials, destinations, tuning
+# knobs and the input keys themselves (their content is keyed through the ETag)
+IGNORED_FIELDS = {
+    "aws_access_key_id", "aws_secret_access_key", "aws_region", "hf_auth_token",
+    "output_key", "output_keys", "use_cache", "batch_size", "face_batch_size",
+    "memory_budget_mb", "transfer_part_size_mb", "transfer_concurrency",
+}
+
+
+class ResultCache:
+    """
+    Map a hash of (handler, model, input object ETags, job parameters) to an
+    output that an earlier job already wrote, so identical work is answered
+    with a server-side copy and a presigned URL instead of a model run.
+
+    Entries live in S3 index objects under `prefix`, with an in-memory LRU in
+    front of them so a worker answers its own repeats without a request.
+    Only jobs that ask for it with "use_cache": true are looked up or stored.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, prefix=RESULT_CACHE_PREFIX):
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.index_hits = 0
+        self.misses = 0
+        self._entries = LRUCache(max_entries)
+        self._lock = threading.Lock()
+
+    def key(self, s3, job_input, handler_name, model_id, input_fields=("input_key",), resolved=None):
+        etags = {}
+        for field in input_fields:
+            if job_input.get(field) is not None:
+                head = s3.head_object(Bucket=job_input["bucket_name"], Key=job_input[field])
+                etags[field] = head["ETag"].strip('"')
+        params = {name: value for name, value in job_input.items()
+                  if name not in IGNORED_FIELDS and name not in input_fields}
+        payload = json.dumps([handler_name, model_id, etags, params, resolved or {}], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def lookup(self, s3, cache_key, bucket_name, output_key):
+        """
+        Return a presigned URL for `output_key` if the result is cached, copying
+        the earlier output there first when needed. Returns None on a miss.
+        """
+        url = self._lookup(s3, cache_key, bucket_name, output_key)
+        with self._lock:
+            if url is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return url
+
+    def _index_key(self, cache_key):
+        return f"{self.prefix}{cache_key}"
+
+    def _entry(self, s3, cache_key, bucket_name):
+        entry = self._entries.get(cache_key)
+        if entry is not None or not self.prefix:
+            return entry
+        # The entry is kept in the metadata of the index object, so a HEAD request reads it
+        try:
+            head = s3.head_object(Bucket=bucket_name, Key=self._index_key(cache_key))
+            metadata = head["Metadata"]
+            entry = (metadata["bucket"], unquote(metadata["key"]), metadata["etag"], float(metadata["created"]))
+        except Exception:
+            return None
+        with self._lock:
+            self.index_hits += 1
+        self._entries.put(cache_key, entry)
+        return entry
+
+    def _lookup(self, s3, cache_key, bucket_name, output_key):
+        entry = self._entry(s3, cache_key, bucket_name)
+        if entry is None:
+            return None
+        cached_bucket, cached_key, etag, created = entry
+        if time.time() - created > self.ttl:
+            return None
+
+        # The earlier output must still exist unchanged
+        try:
+            head = s3.head_object(Bucket=cached_bucket, Key=cached_key)
+        except Exception:
+            return None
+        if head["ETag"].strip('"') != etag:
+            return None
+
+        if (cached_bucket, cached_key) != (bucket_name, output_key):
+            s3.copy({'Bucket': cached_bucket, 'Key': cached_key}, bucket_name, output_key)
+        return s3.generate_presigned_url('get_object',
+                                         Params={'Bucket': bucket_name,
+                                                 'Key': output_key}, ExpiresIn=3600)
+
+    def store(self, s3, cache_key, bucket_name, output_key):
+        etag = s3.head_object(Bucket=bucket_name, Key=output_key)["ETag"].strip('"')
+        created = time.time()
+        self._entries.put(cache_key, (bucket_name, output_key, etag, created))
+        if not self.prefix:
+            return
+        # The result is already delivered, so a failed index write only costs other workers a hit
+        try:
+            s3.put_object(Bucket=bucket_name, Key=self._index_key(cache_key), Body=b"",
+                          Metadata={"bucket": bucket_name, "key": quote(output_key), "etag": etag,
+                                    "created": str(created)})
+        except Exception as e:
+            print(f"Could not write result cache index for {cache_key}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "index_hits": self.index_hits,
+                    "misses": self.misses}
+
+
+result_cache = ResultCache()
+
+
+def check_result_cache(s3, job_input, output_key, handler_name, model_id, input_fields=("input_key",),
+                       resolved=None):
+    """
+    Return (cache_key, cached_url). cached_url is None on a miss, and both are
+    None unless the job opted in with "use_cache": true, so other jobs make no
+    extra S3 requests. `resolved` holds
+    settings the handler derived itself that change the output, such as a
+    plan picked from the worker's memory.
+    """
+    if not job_input.get("use_cache", False):
+        return None, None
+    cache_key = result_cache.key(s3, job_input, handler_name, model_id, input_fields, resolved)
+    return cache_key, result_cache.lookup(s3, cache_key, job_input["bucket_name"], output_key)
+
+
+def store_result(s3, cache_key, bucket_name, output_key):
+    if cache_key is not None:
+        result_cache.store(s3, cache_key, bucket_name, output_key)
@@ -0,0 +1,68 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import boto3
+from botocore.config import Config
+
+# Clients are kept per (endpoint, region, credentials). Idle or least recently
+# used clients are dropped so a worker serving many tenants stays bounded.
+MAX_CLIENTS = int(os.environ.get("S3_CLIENT_POOL_SIZE", 16))
+IDLE_TIMEOUT = int(os.environ.get("S3_CLIENT_IDLE_TIMEOUT", 15 * 60))
+
+# Connections kept open by each client, reused across jobs
+MAX_POOL_CONNECTIONS = 32
+
+_clients = OrderedDict()
+_lock = threading.Lock()
+
+
+def _client_key(aws_access_key_id, aws_secret_access_key, aws_region, endpoint):
+    # The secret is only kept as a digest, so rotated keys get a fresh client
+    secret_digest = hashlib.sha256(aws_secret_access_key.encode()).hexdigest()
+    return endpoint, aws_region, aws_access_key_id, secret_digest
+
+
+def _evict(now):
+    for key in [key for key, (_, last_used) in _clients.items() if now - last_used > IDLE_TIMEOUT]:
+        del _clients[key]
+    while len(_clients) > MAX_CLIENTS:
+        _clients.popitem(last=False)
+
+
+def get_s3_client(aws_access_key_id, aws_secret_access_key, aws_region, endpoint=None):
+    """
+    Return a pooled S3 client for these credentials and endpoint.
+
+    Credentials are passed to the client explicitly instead of through
+    os.environ, so jobs with different credentials can run side by side.
+    """
+    key = _client_key(aws_access_key_id, aws_secret_access_key, aws_region, endpoint)
+    now = time.monotonic()
+
+    with _lock:
+        if key in _clients:
+            client = _clients[key][0]
+            _clients[key] = (client, now)
+            _clients.move_to_end(key)
+            return client
+
+        client = boto3.session.Session().client(
+            's3',
+            endpoint_url=endpoint,
+            region_name=aws_region,
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            config=Config(max_pool_connections=MAX_POOL_CONNECTIONS, tcp_keepalive=True,
+                          retries={'max_attempts': 5, 'mode': 'adaptive'})
+        )
+        _clients[key] = (client, now)
+        _evict(now)
+        return client
+
+
+def clear_s3_clients():
+    with _lock:
+        _clients.clear()
@@ -0,0 +1,72 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from common.residency import load_resident
+
+# Print one JSON line per stage and one per job, for log-based dashboards
+TIMING_LOG = os.environ.get("TIMING_LOG", "0") == "1"
+
+
+class Timings:
+    """
+    Seconds spent per stage of one job (s3_download, decode, model_load,
+    preprocess, inference, encode, s3_upload, presign, ...).
+
+    Stages that ran more than once, or on several threads, are summed. Stages
+    that only happen on a cold worker are reported apart under "cold_start",
+    so warm latency can be read without them.
+    """
+
+    def __init__(self, job, handler_name):
+        self.job_id = job.get("id")
+        self.handler_name = handler_name
+        self.stages = {}
+        self.cold_start = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage, cold=False):
+        """
+        Time the block under `stage`. The yielded dict can set "cold" once it
+        is known whether the block paid a one-off cost.
+        """
+        info = {"cold": cold}
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.add(stage, time.perf_counter() - start, info["cold"])
+
+    def add(self, stage, seconds, cold=False):
+        with self._lock:
+            stages = self.cold_start if cold else self.stages
+            stages[stage] = stages.get(stage, 0.0) + seconds
+        if TIMING_LOG:
+            print(json.dumps({"event": "stage", "job_id": self.job_id, "handler": self.handler_name,
+                              "stage": stage, "seconds": round(seconds, 4), "cold": cold}), flush=True)
+
+    def load_resident(self, name, loader):
+        """
+        common.residency.load_resident, timed as model_load and flagged cold
+        when this job paid for the load.
+        """
+        with self.span("model_load") as info:
+            model, warm = load_resident(name, loader)
+            info["cold"] = not warm
+        return model, warm
+
+    def report(self):
+        with self._lock:
+            report = {
+                "stages": {stage: round(seconds, 4) for stage, seconds in self.stages.items()},
+                "cold_start": {stage: round(seconds, 4) for stage, seconds in self.cold_start.items()},
+                "total": round(time.perf_counter() - self._start, 4),
+            }
+        if TIMING_LOG:
+            print(json.dumps({"event": "job", "job_id": self.job_id, "handler": self.handler_name, **report}),
+                  flush=True)
+        return report
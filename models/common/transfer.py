@@ -0,0 +1,60 @@
+import os
+import time
+
+from boto3.s3.transfer import TransferConfig
+
+# Objects above the part size are split into ranged GETs / multipart parts
+# and moved by `concurrency` threads, streaming to and from disk.
+DEFAULT_PART_SIZE_MB = 16
+DEFAULT_CONCURRENCY = 8
+
+
+def transfer_options(job_input):
+    """
+    Read the optional transfer tuning parameters from a job input.
+    """
+    return {
+        "part_size_mb": int(job_input.get("transfer_part_size_mb", DEFAULT_PART_SIZE_MB)),
+        "concurrency": int(job_input.get("transfer_concurrency", DEFAULT_CONCURRENCY)),
+    }
+
+
+def _config(part_size_mb, concurrency):
+    part_size = part_size_mb * 1024 * 1024
+    return TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                          max_concurrency=concurrency, use_threads=concurrency > 1)
+
+
+def _stats(direction, key, path, start):
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(path)
+    stats = {
+        "direction": direction,
+        "key": key,
+        "bytes": size,
+        "seconds": round(seconds, 3),
+        "mb_per_s": round(size / (1024 * 1024) / seconds, 2) if seconds > 0 else None,
+    }
+    print(f"S3 {direction} of {key}: {size} bytes in {stats['seconds']}s ({stats['mb_per_s']} MB/s)")
+    return stats
+
+
+def download_file(s3, bucket_name, key, path, part_size_mb=DEFAULT_PART_SIZE_MB,
+                  concurrency=DEFAULT_CONCURRENCY):
+    """
+    Stream an object to `path` with parallel ranged GETs and return its transfer stats.
+    """
+    start = time.perf_counter()
+    s3.download_file(bucket_name, key, path, Config=_config(part_size_mb, concurrency))
+    return _stats("download", key, path, start)
+
+
+def upload_file(s3, bucket_name, key, path, content_type, part_size_mb=DEFAULT_PART_SIZE_MB,
+                concurrency=DEFAULT_CONCURRENCY):
+    """
+    Upload `path` with concurrent multipart parts and return its transfer stats.
+    """
+    start = time.perf_counter()
+    s3.upload_file(path, bucket_name, key, ExtraArgs={'ContentType': content_type},
+                   Config=_config(part_size_mb, concurrency))
+    return _stats("upload", key, path, start)
@@ -0,0 +1,100 @@
+import queue
+import subprocess
+import threading
+
+_END = object()
+
+
+def chunked(iterable, size):
+    """
+    Yield lists of at most `size` items from `iterable` without reading ahead.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def prefetch(iterable, depth=2):
+    """
+    Run `iterable` on a background thread, keeping at most `depth` items ready.
+
+    The consumer works on one item while the next ones are produced, and memory
+    stays bounded because the producer blocks once the queue is full.
+    Exceptions raised by the producer are re-raised in the consumer.
+    """
+    items = queue.Queue(maxsize=depth)
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        finally:
+            items.put(_END)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is _END:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+class VideoWriter:
+    """
+    Encode RGB frames through a single ffmpeg process fed over a pipe.
+
+    When `audio_path` is given the audio track is muxed in the same pass, so no
+    intermediate video file is written. ffmpeg is started on the first frame,
+    once the frame size is known.
+    """
+
+    def __init__(self, output_path, fps, audio_path=None, codec_args=None):
+        self.output_path = output_path
+        self.fps = fps
+        self.audio_path = audio_path
+        self.codec_args = codec_args or ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p']
+        self.process = None
+        self.frame_count = 0
+
+    def _open(self, width, height):
+        command = ['ffmpeg', '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', str(self.fps),
+                   '-i', '-']
+        if self.audio_path:
+            # The trailing '?' keeps sources without an audio track working
+            command += ['-i', self.audio_path, '-map', '0:v', '-map', '1:a?', '-c:a', 'aac', '-shortest']
+        command += self.codec_args + [self.output_path]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        if self.process is None:
+            height, width = frame.shape[:2]
+            self._open(width, height)
+        self.process.stdin.write(frame.tobytes())
+        self.frame_count += 1
+
+    def close(self):
+        if self.process is None:
+            raise ValueError("No frames were written to the video")
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed while writing {self.output_path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self.process is not None:
+            self.process.kill()
+            self.process.wait()
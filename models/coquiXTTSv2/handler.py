@@ -1,12 +1,23 @@
 import os
 import io
-import boto3
+import sys
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch
 import runpod
 import soundfile as sf
 from TTS.api import TTS
+from TTS.tts.layers.xtts.tokenizer import split_sentence
 from pydub import AudioSegment
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.assets import ModelAssets
+from common.lru import LRUCache
+from common.result_cache import check_result_cache, store_result
+from common.s3 import get_s3_client
+from common.timing import Timings
+
 # Supported languages by XTTS-v2
 SUPPORTED_LANGUAGES = {
     "en": "English",
@@ -28,6 +39,27 @@ SUPPORTED_LANGUAGES = {
     "hi": "Hindi"
 }
 
+# Uploads running in the background while batch items are synthesized
+BATCH_UPLOAD_WORKERS = 4
+
+# Weights listed in assets.json, baked into the image at build time
+assets = ModelAssets(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_tts(device):
+    model_dir = assets.repo("coqui/XTTS-v2")
+    if os.path.isdir(model_dir):
+        tts = TTS(model_path=model_dir, config_path=os.path.join(model_dir, "config.json"))
+    else:
+        tts = TTS("tts_models/multilingual/multi-dataset/xtts_v2")
+    return tts.to(device)
+
+
+def check_language(language):
+    if language not in SUPPORTED_LANGUAGES:
+        raise ValueError(
+            f"Language {language} not supported. Supported languages: {', '.join(SUPPORTED_LANGUAGES.keys())}")
+
 
 def download_and_convert_audio(s3_client, bucket_name, reference_key):
     """
@@ -68,96 +100,271 @@ def download_and_convert_audio(s3_client, bucket_name, reference_key):
         raise
 
 
+# Speaker conditioning is cached per reference clip, keyed by the clip's ETag and the conditioning settings.
+# Setting XTTS_SPEAKER_CACHE_DIR also keeps it on disk across worker restarts.
+SPEAKER_CACHE_SIZE = int(os.environ.get("XTTS_SPEAKER_CACHE_SIZE", 512))
+SPEAKER_CACHE_DIR = os.environ.get("XTTS_SPEAKER_CACHE_DIR")
+speaker_cache = LRUCache(SPEAKER_CACHE_SIZE)
+
+
+def conditioning_settings(config):
+    """
+    Conditioning arguments tts_to_file(speaker_wav=...) takes from the model
+    config, so cached latents give the same voice as the uncached path
+    """
+    return {
+        "gpt_cond_len": config.gpt_cond_len,
+        "gpt_cond_chunk_len": config.gpt_cond_chunk_len,
+        "max_ref_length": config.max_ref_len,
+        "sound_norm_refs": config.sound_norm_refs
+    }
+
+
+def sampling_settings(config):
+    """
+    Sampling arguments tts_to_file takes from the model config
+    """
+    return {
+        "temperature": config.temperature,
+        "length_penalty": config.length_penalty,
+        "repetition_penalty": config.repetition_penalty,
+        "top_k": config.top_k,
+        "top_p": config.top_p
+    }
+
+
+# Latents depend on the clip and on the conditioning settings they were computed with
+def speaker_cache_key(etag, settings):
+    return hashlib.sha256(f"{etag}:{sorted(settings.items())}".encode()).hexdigest()
+
+
+def speaker_cache_path(key):
+    return os.path.join(SPEAKER_CACHE_DIR, key + ".pt")
+
+
+def get_speaker_latents(xtts, s3_client, bucket_name, reference_key, timings):
+    """
+    Return ((gpt_cond_latent, speaker_embedding), cache_hit) for a reference clip.
+    On a hit only a HEAD request is made: no download, transcode or conditioning pass.
+    """
+    etag = s3_client.head_object(Bucket=bucket_name, Key=reference_key)["ETag"].strip('"')
+    settings = conditioning_settings(xtts.config)
+    key = speaker_cache_key(etag, settings)
+    latents = speaker_cache.get(key)
+    if latents is not None:
+        return latents, True
+
+    device = next(xtts.parameters()).device
+    if SPEAKER_CACHE_DIR and os.path.exists(speaker_cache_path(key)):
+        saved = torch.load(speaker_cache_path(key), map_location=device)
+        latents = (saved["gpt_cond_latent"], saved["speaker_embedding"])
+        speaker_cache.put(key, latents)
+        return latents, True
+
+    # Process reference audio and compute its conditioning once
+    with timings.span("s3_download"):
+        reference_path = download_and_convert_audio(s3_client, bucket_name, reference_key)
+    try:
+        with timings.span("preprocess"):
+            latents = xtts.get_conditioning_latents(audio_path=[reference_path], **settings)
+    finally:
+        os.remove(reference_path)
+    speaker_cache.put(key, latents)
+
+    if SPEAKER_CACHE_DIR:
+        os.makedirs(SPEAKER_CACHE_DIR, exist_ok=True)
+        gpt_cond_latent, speaker_embedding = latents
+        torch.save({"gpt_cond_latent": gpt_cond_latent.cpu(), "speaker_embedding": speaker_embedding.cpu()},
+                   speaker_cache_path(key))
+    return latents, False
+
+
+def synthesize(tts, text, language, latents=None):
+    """
+    Synthesize `text` and return the waveform as a float32 numpy array
+    """
+    if latents is None:
+        return np.array(tts.tts(text=text, language=language, speed=1.0), dtype=np.float32)
+    gpt_cond_latent, speaker_embedding = latents
+    xtts = tts.synthesizer.tts_model
+    out = xtts.inference(
+        text,
+        language,
+        gpt_cond_latent,
+        speaker_embedding,
+        speed=1.0,
+        enable_text_splitting=True,
+        **sampling_settings(xtts.config)
+    )
+    return np.asarray(out["wav"], dtype=np.float32)
+
+
+def upload_audio(s3_client, bucket_name, key, wav, sample_rate, timings):
+    """
+    Encode a waveform as WAV, upload it and return a presigned URL for it
+    """
+    with timings.span("encode"):
+        buffer = io.BytesIO()
+        sf.write(buffer, wav, sample_rate, format="WAV")
+        buffer.seek(0)
+    with timings.span("s3_upload"):
+        s3_client.upload_fileobj(
+            buffer,
+            bucket_name,
+            key,
+            ExtraArgs={
+                'ContentType': 'audio/wav'
+            }
+        )
+    with timings.span("presign"):
+        return s3_client.generate_presigned_url(
+            'get_object',
+            Params={
+                'Bucket': bucket_name,
+                'Key': key
+            },
+            ExpiresIn=3600
+        )
+
+
+def synthesize_batch(tts, s3_client, bucket_name, items, default_language, latents, sample_rate, timings):
+    """
+    Synthesize every item back to back with the model and voice kept hot,
+    uploading finished items while the next ones are synthesized
+    """
+    for item in items:
+        check_language(item.get("language", default_language))
+
+    with ThreadPoolExecutor(max_workers=BATCH_UPLOAD_WORKERS) as uploads:
+        pending = []
+        for item in items:
+            language = item.get("language", default_language)
+            with timings.span("inference"):
+                wav = synthesize(tts, item["text"], language, latents)
+            pending.append((item["output_key"], language,
+                            uploads.submit(upload_audio, s3_client, bucket_name, item["output_key"], wav, sample_rate,
+                                           timings)))
+
+        return [
+            {
+                "output_key": key,
+                "audio_url": upload.result(),
+                "language": language,
+                "language_name": SUPPORTED_LANGUAGES[language]
+            }
+            for key, language, upload in pending
+        ]
+
+
+def segment_key(output_key, index):
+    root, ext = os.path.splitext(output_key)
+    return f"{root}.part{index:03d}{ext or '.wav'}"
+
+
+# With "stream" set, each sentence is uploaded as soon as it is synthesized and a
+# progress update, readable from /status while the job runs, lists the URLs of all
+# segments so far: /status only keeps the latest update, so a client polling less
+# often than segments arrive still sees every one. The result is the full file as
+# usual, with the segment URLs. Jobs with "items" synthesize a list of {text,
+# language, output_key} with one shared voice and return a single manifest.
 def handler(job):
     try:
         job_input = job["input"]
+        timings = Timings(job, "coquiXTTSv2")
         bucket_name = job_input["bucket_name"]
-        output_key = job_input["output_key"]
+        output_key = job_input.get("output_key", None)
         aws_access_key_id = job_input["aws_access_key_id"]
         aws_secret_access_key = job_input["aws_secret_access_key"]
         aws_region = job_input["aws_region"]
         endpoint = job_input.get("endpoint", None)
         text = job_input.get("text", "Hello, this is a test of text to speech.")
         language = job_input.get("language", "en")
+        stream = job_input.get("stream", False)  # Yield each sentence as soon as it is synthesized
+        items = job_input.get("items", None)  # Batch of utterances sharing one voice
 
         # Voice cloning parameters
         reference_key = job_input.get("reference_key", None)
         use_voice_cloning = reference_key is not None
 
-        if language not in SUPPORTED_LANGUAGES:
-            raise ValueError(
-                f"Language {language} not supported. Supported languages: {', '.join(SUPPORTED_LANGUAGES.keys())}")
+        check_language(language)
+        if items is None and output_key is None:
+            raise ValueError("Either output_key or items must be provided")
 
-        # Set AWS credentials and region
-        os.environ['AWS_ACCESS_KEY_ID'] = aws_access_key_id
-        os.environ['AWS_SECRET_ACCESS_KEY'] = aws_secret_access_key
-        os.environ['AWS_DEFAULT_REGION'] = aws_region
+        # Reuse a pooled S3 client for these credentials and endpoint
+        s3 = get_s3_client(aws_access_key_id, aws_secret_access_key, aws_region, endpoint)
 
-        # Initialize S3 client
-        s3 = boto3.client('s3', endpoint_url=endpoint)
+        # Single-utterance jobs are answered from the result cache without loading the model
+        cache_key = None
+        if items is None and not stream:
+            with timings.span("cache_lookup"):
+                cache_key, cached_url = check_result_cache(s3, job_input, output_key, "coquiXTTSv2", "xtts_v2",
+                                                           ("reference_key",))
+            if cached_url is not None:
+                return {
+                    "audio_url": cached_url,
+                    "language": language,
+                    "language_name": SUPPORTED_LANGUAGES[language],
+                    "used_voice_cloning": use_voice_cloning,
+                    "cache_hit": True,
+                    "timings": timings.report()
+                }
 
-        # Initialize TTS model
+        # Initialize TTS model once per worker
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        tts = TTS("tts_models/multilingual/multi-dataset/xtts_v2").to(device)
-
-        # Output path for generated audio
-        output_path = "/tmp/output.wav"
+        tts, _ = timings.load_resident("xtts_v2", lambda: load_tts(device))
+        xtts = tts.synthesizer.tts_model
+        sample_rate = xtts.config.audio.output_sample_rate
 
+        # Reuse the speaker conditioning of this reference clip when cached
+        latents = None
+        speaker_cache_hit = False
         if use_voice_cloning:
-            # Process reference audio
-            reference_path = download_and_convert_audio(s3, bucket_name, reference_key)
-
-            # Generate speech with voice cloning
-            tts.tts_to_file(
-                text=text,
-                file_path=output_path,
-                speaker_wav=reference_path,
-                language=language,
-                speed=1.0
-            )
-
-            # Clean up reference file
-            os.remove(reference_path)
-        else:
-            # Generate speech without voice cloning
-            tts.tts_to_file(
-                text=text,
-                file_path=output_path,
-                language=language,
-                speed=1.0
-            )
-
-        # Upload to S3
-        with open(output_path, 'rb') as audio_file:
-            s3.upload_fileobj(
-                audio_file,
-                bucket_name,
-                output_key,
-                ExtraArgs={
-                    'ContentType': 'audio/wav'
-                }
-            )
+            latents, speaker_cache_hit = get_speaker_latents(xtts, s3, bucket_name, reference_key, timings)
 
-        # Generate presigned URL
-        presigned_url = s3.generate_presigned_url(
-            'get_object',
-            Params={
-                'Bucket': bucket_name,
-                'Key': output_key
-            },
-            ExpiresIn=3600
-        )
+        if items is not None:
+            return {
+                "items": synthesize_batch(tts, s3, bucket_name, items, language, latents, sample_rate, timings),
+                "used_voice_cloning": use_voice_cloning,
+                "speaker_cache_hit": speaker_cache_hit,
+                "timings": timings.report()
+            }
 
-        # Clean up generated audio file
-        os.remove(output_path)
+        if stream:
+            # Synthesize sentence by sentence and hand out each segment as soon as it is uploaded
+            sentences = split_sentence(text, language, xtts.tokenizer.char_limits[language])
+            wavs = []
+            segment_urls = []
+            for index, sentence in enumerate(sentences):
+                with timings.span("inference"):
+                    wav = synthesize(tts, sentence, language, latents)
+                wavs.append(wav)
+                segment_urls.append(upload_audio(s3, bucket_name, segment_key(output_key, index), wav, sample_rate,
+                                                 timings))
+                runpod.serverless.progress_update(job, {
+                    "segment_count": len(sentences),
+                    "segment_urls": list(segment_urls),
+                    "text": sentence
+                })
+            wav = np.concatenate(wavs) if wavs else np.zeros(0, dtype=np.float32)
+        else:
+            with timings.span("inference"):
+                wav = synthesize(tts, text, language, latents)
 
-        # Return response with additional metadata
-        return {
-            "audio_url": presigned_url,
+        # Upload the full audio and return it with additional metadata
+        audio_url = upload_audio(s3, bucket_name, output_key, wav, sample_rate, timings)
+        store_result(s3, cache_key, bucket_name, output_key)
+        result = {
+            "audio_url": audio_url,
             "language": language,
             "language_name": SUPPORTED_LANGUAGES[language],
-            "used_voice_cloning": use_voice_cloning
+            "used_voice_cloning": use_voice_cloning,
+            "speaker_cache_hit": speaker_cache_hit,
+            "cache_hit": False,
+            "timings": timings.report()
         }
+        if stream:
+            result["segment_urls"] = segment_urls
+        return result
 
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -1,93 +1,307 @@
 import os
 import io
-import boto3
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import cv2
 import numpy as np
 from PIL import Image
 from insightface.app import FaceAnalysis
+from insightface.app.common import Face
 from insightface.model_zoo import get_model
 import runpod
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.assets import ModelAssets
+from common.encode import image_format, upload_image
+from common.concurrency import async_handler, concurrency_modifier, inference_slot
+from common.lru import LRUCache
+from common.residency import model_state
+from common.result_cache import check_result_cache, store_result
+from common.s3 import get_s3_client
+from common.timing import Timings
+from common.transfer import download_file, transfer_options, upload_file
+from common.video import VideoWriter, prefetch
+
+# Weights listed in assets.json, baked into the image at build time
+assets = ModelAssets(os.path.dirname(os.path.abspath(__file__)))
+
+# Name the detector and swapper are kept under; jobs take turns on them through its inference slot
+MODEL_NAME = "insightface-inswapper"
+
+# Faces detected in source images, keyed by the source object's ETag
+SOURCE_FACE_CACHE_SIZE = int(os.environ.get("FACESWAP_SOURCE_CACHE_SIZE", 256))
+source_face_cache = LRUCache(SOURCE_FACE_CACHE_SIZE)
+
+# Results encoded and uploaded in the background while the next destination is swapped
+UPLOAD_WORKERS = 4
+MAX_PENDING_UPLOADS = 8
+
+# Video mode: full detection every N frames or on a scene change, tracking in between
+DEFAULT_DETECT_EVERY = 10
+SCENE_CHANGE_THRESHOLD = 30.0  # Mean absolute difference of 64x36 grayscale thumbnails
+SMOOTHING = 0.6  # Weight of the newest position in the moving average of the face
+
+
+# Initialize FaceAnalysis and the swapper model
+def load_models():
+    # insightface finds the unpacked buffalo_l pack under <root>/models/buffalo_l
+    root = os.path.dirname(os.path.dirname(assets.path('insightface/models/buffalo_l')))
+    app = FaceAnalysis(name='buffalo_l', root=root)
+    app.prepare(ctx_id=0, det_size=(640, 640))
+    swapper = get_model(assets.path('inswapper_128.onnx'), download=False)
+    return app, swapper
+
+
+# Load an image from S3 as an RGB numpy array
+def load_image(s3, bucket_name, key, timings):
+    with timings.span("s3_download"):
+        data = s3.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+    with timings.span("decode"):
+        return np.array(Image.open(io.BytesIO(data)).convert("RGB"))
+
+
+def get_faces(app, image_np):
+    faces = app.get(image_np)
+    return sorted(faces, key=lambda x: x.bbox[0])
+
+
+def get_face(faces, face_id):
+    if len(faces) < face_id or face_id < 1:
+        raise ValueError(f"The image includes only {len(faces)} faces, however, you asked for face {face_id}")
+    return faces[face_id - 1]
+
+
+# Detected faces (bbox, landmarks, embedding) of a source image, from the cache when possible
+def get_source_faces(app, s3, bucket_name, source_key, timings):
+    etag = s3.head_object(Bucket=bucket_name, Key=source_key)["ETag"].strip('"')
+    faces = source_face_cache.get(etag)
+    if faces is not None:
+        return faces, True
+
+    image_np = load_image(s3, bucket_name, source_key, timings)
+    with inference_slot(MODEL_NAME), timings.span("preprocess"):
+        faces = get_faces(app, image_np)
+    source_face_cache.put(etag, faces)
+    return faces, False
+
+
+class FaceTracker:
+    """
+    Follow one destination face through a video.
+
+    FaceAnalysis runs only every `detect_every` frames, on a scene change or when
+    tracking is lost. In between, the five landmarks are moved with Lucas-Kanade
+    optical flow, and box and landmarks are smoothed with a moving average.
+    """
+
+    def __init__(self, app, face_index, detect_every=DEFAULT_DETECT_EVERY):
+        self.app = app
+        self.face_index = face_index
+        self.detect_every = max(1, int(detect_every))
+        self.face = None
+        self.prev_gray = None
+        self.prev_thumb = None
+        self.frame_index = 0
+        self.detections = 0
+
+    def _detect(self, frame):
+        self.detections += 1
+        faces = get_faces(self.app, frame)
+        if len(faces) < self.face_index:
+            return None
+        return faces[self.face_index - 1]
+
+    def _follow(self, gray):
+        points = self.face.kps.astype(np.float32).reshape(-1, 1, 2)
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, points, None)
+        if moved is None or not status.all():
+            return None
+        kps = moved.reshape(-1, 2)
+        shift = (kps - self.face.kps).mean(axis=0)
+        return Face(bbox=self.face.bbox + np.tile(shift, 2), kps=kps, det_score=self.face.det_score)
+
+    def update(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        thumb = cv2.resize(gray, (64, 36))
+        scene_change = (self.prev_thumb is not None and
+                        np.mean(cv2.absdiff(thumb, self.prev_thumb)) > SCENE_CHANGE_THRESHOLD)
+
+        face = None
+        if self.face is not None and not scene_change and self.frame_index % self.detect_every != 0:
+            face = self._follow(gray)
+        if face is None:
+            face = self._detect(frame)
+
+        # Smooth against the previous position unless the shot changed
+        if face is not None and self.face is not None and not scene_change:
+            face = Face(bbox=SMOOTHING * face.bbox + (1 - SMOOTHING) * self.face.bbox,
+                        kps=SMOOTHING * face.kps + (1 - SMOOTHING) * self.face.kps,
+                        det_score=face.det_score)
+
+        self.face = face
+        self.prev_gray = gray
+        self.prev_thumb = thumb
+        self.frame_index += 1
+        return face
+
+
+# Decode a video file frame by frame as RGB numpy arrays
+def read_frames(video_path):
+    capture = cv2.VideoCapture(video_path)
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    finally:
+        capture.release()
+
+
+def swap_video(app, swapper, s3, bucket_name, video_key, output_key, source_face, face_index, detect_every, options,
+               timings):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        video_path = os.path.join(tmpdir, "input_video.mp4")
+        output_path = os.path.join(tmpdir, "output_video.mp4")
+        with timings.span("s3_download"):
+            transfers = [download_file(s3, bucket_name, video_key, video_path, **options)]
+
+        capture = cv2.VideoCapture(video_path)
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25
+        capture.release()
+
+        # Frames are decoded ahead on a background thread and encoded as they are swapped,
+        # the source audio is muxed back in the same ffmpeg pass
+        tracker = FaceTracker(app, face_index, detect_every)
+        with VideoWriter(output_path, fps, audio_path=video_path) as out:
+            for frame in prefetch(read_frames(video_path), depth=32):
+                with inference_slot(MODEL_NAME), timings.span("inference"):
+                    face = tracker.update(frame)
+                    if face is not None:
+                        frame = swapper.get(frame, face, source_face, paste_back=True)
+                with timings.span("encode"):
+                    out.write(frame)
+
+        with timings.span("s3_upload"):
+            transfers.append(upload_file(s3, bucket_name, output_key, output_path, 'video/mp4', **options))
+
+    with timings.span("presign"):
+        video_url = s3.generate_presigned_url('get_object',
+                                              Params={'Bucket': bucket_name,
+                                                      'Key': output_key}, ExpiresIn=3600)
+    return {
+        "video_url": video_url,
+        "frames": tracker.frame_index,
+        "detections": tracker.detections,
+        "transfers": transfers
+    }
+
+
 def handler(job):
     job_input = job["input"]
+    timings = Timings(job, "dentro_faceswap")
     bucket_name = job_input["bucket_name"]
     source_key = job_input["source_key"]
-    destination_key = job_input["destination_key"]
-    output_key = job_input["output_key"]
     aws_access_key_id = job_input["aws_access_key_id"]
     aws_secret_access_key = job_input["aws_secret_access_key"]
     aws_region = job_input["aws_region"]
     source_face_index = int(job_input["source_face_index"])
     destination_face_index = int(job_input["destination_face_index"])
     endpoint = job_input.get("endpoint", None)
+    output_format = image_format(job_input)  # Optional output_format / output_quality, PNG by default
 
-    # Set AWS credentials and region
-    os.environ['AWS_ACCESS_KEY_ID'] = aws_access_key_id
-    os.environ['AWS_SECRET_ACCESS_KEY'] = aws_secret_access_key
-    os.environ['AWS_DEFAULT_REGION'] = aws_region
-
-    # Initialize S3 client with a custom endpoint if provided
-    s3 = boto3.client('s3', endpoint_url=endpoint)
+    # A video_key swaps the source face into every frame of a video
+    video_key = job_input.get("video_key", None)
 
-    # Load the source image from S3
-    response = s3.get_object(Bucket=bucket_name, Key=source_key)
-    source_image_data = response['Body'].read()
-    source_image = Image.open(io.BytesIO(source_image_data)).convert("RGB")
+    # One source can be swapped into many destinations with destination_keys / output_keys
+    single_destination = "destination_keys" not in job_input
+    if video_key is not None:
+        output_key = job_input["output_key"]
+    elif single_destination:
+        output_key = job_input["output_key"]
+        destination_keys = [job_input["destination_key"]]
+        output_keys = [output_key]
+    else:
+        destination_keys = job_input["destination_keys"]
+        output_keys = job_input["output_keys"]
+        if len(destination_keys) != len(output_keys):
+            raise ValueError("destination_keys and output_keys must have the same length")
 
-    # Load the destination image from S3
-    response = s3.get_object(Bucket=bucket_name, Key=destination_key)
-    destination_image_data = response['Body'].read()
-    destination_image = Image.open(io.BytesIO(destination_image_data)).convert("RGB")
+    # Reuse a pooled S3 client for these credentials and endpoint
+    s3 = get_s3_client(aws_access_key_id, aws_secret_access_key, aws_region, endpoint)
 
-    # Convert PIL image to numpy array
-    def pil_to_np(image):
-        return np.array(image)
+    # Single-output jobs are answered from the result cache without loading any model
+    cache_key = None
+    if video_key is not None or single_destination:
+        url_field = "video_url" if video_key is not None else "image_url"
+        with timings.span("cache_lookup"):
+            cache_key, cached_url = check_result_cache(s3, job_input, output_key, "dentro_faceswap",
+                                                       "buffalo_l+inswapper_128",
+                                                       ("source_key", "destination_key", "video_key"))
+        if cached_url is not None:
+            return {url_field: cached_url, "cache_hit": True, "timings": timings.report()}
 
-    # Initialize FaceAnalysis and the swapper model
-    app = FaceAnalysis(name='buffalo_l')
-    app.prepare(ctx_id=0, det_size=(640, 640))
-    model_path = '/inswapper_128.onnx'  # sau folosește calea corectă
-    swapper = get_model(model_path, download=False)
-
-    # Prepare the images
-    def get_faces(image_np):
-        faces = app.get(image_np)
-        return sorted(faces, key=lambda x: x.bbox[0])
-
-    def get_face(faces, face_id):
-        if len(faces) < face_id or face_id < 1:
-            raise ValueError(f"The image includes only {len(faces)} faces, however, you asked for face {face_id}")
-        return faces[face_id - 1]
+    # Reuse the detector and swapper kept by this worker
+    (app, swapper), warm = timings.load_resident(MODEL_NAME, load_models)
 
-    # Convert images to numpy arrays
-    source_image_np = pil_to_np(source_image)
-    destination_image_np = pil_to_np(destination_image)
-
-    # Detect faces in the source image
-    source_faces = get_faces(source_image_np)
+    # Detect faces in the source image, once per distinct source
+    source_faces, source_cache_hit = get_source_faces(app, s3, bucket_name, source_key, timings)
     source_face = get_face(source_faces, source_face_index)
 
-    # Detect faces in the destination image
-    destination_faces = get_faces(destination_image_np)
-    destination_face = get_face(destination_faces, destination_face_index)
+    if video_key is not None:
+        response = swap_video(app, swapper, s3, bucket_name, video_key, output_key, source_face,
+                              destination_face_index, job_input.get("detect_every", DEFAULT_DETECT_EVERY),
+                              transfer_options(job_input), timings)
+        store_result(s3, cache_key, bucket_name, output_key)
+        response.update(model_state=model_state(warm), source_cache_hit=source_cache_hit, cache_hit=False,
+                        timings=timings.report())
+        return response
+
+    # Download the next destinations in the background while the current one is swapped
+    destinations = prefetch(((key, load_image(s3, bucket_name, key, timings)) for key in destination_keys), depth=2)
 
-    # Perform the face swap
-    result_image_np = swapper.get(destination_image_np, destination_face, source_face, paste_back=True)
+    results = []
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as uploads:
+        pending = []
+        for (destination_key, destination_image_np), output_key in zip(destinations, output_keys):
+            with inference_slot(MODEL_NAME), timings.span("inference"):
+                # Detect faces in the destination image
+                destination_faces = get_faces(app, destination_image_np)
+                destination_face = get_face(destination_faces, destination_face_index)
 
-    # Convert numpy array back to PIL image
-    result_image = Image.fromarray(result_image_np)
+                # Perform the face swap
+                result_image_np = swapper.get(destination_image_np, destination_face, source_face, paste_back=True)
+            pending.append((destination_key, output_key,
+                            uploads.submit(upload_image, s3, bucket_name, output_key, result_image_np,
+                                           output_format, timings)))
 
-    # Save the result image to a BytesIO buffer
-    buffer = io.BytesIO()
-    result_image.save(buffer, format="PNG")
-    buffer.seek(0)
+            # Keep the number of results waiting for upload bounded
+            if len(pending) > MAX_PENDING_UPLOADS:
+                pending[-MAX_PENDING_UPLOADS - 1][2].result()
 
-    # Upload the result image to S3
-    s3.put_object(Bucket=bucket_name, Key=output_key, Body=buffer, ContentType='image/png')
+        for destination_key, output_key, upload in pending:
+            image_url, encoded = upload.result()
+            results.append({
+                "destination_key": destination_key,
+                "output_key": output_key,
+                "image_url": image_url,
+                "encoding": encoded
+            })
 
-    # Return a presigned URL for the output image
-    response = s3.generate_presigned_url('get_object',
-                                         Params={'Bucket': bucket_name,
-                                                 'Key': output_key}, ExpiresIn=3600)
+    response = {
+        "model_state": model_state(warm),
+        "source_cache_hit": source_cache_hit
+    }
+    if single_destination:
+        store_result(s3, cache_key, bucket_name, output_key)
+        response["image_url"] = results[0]["image_url"]
+        response["encoding"] = results[0]["encoding"]
+        response["cache_hit"] = False
+    else:
+        response["images"] = results
+    response["timings"] = timings.report()
     return response
 
-runpod.serverless.start({"handler": handler})
+# Several jobs run at once so S3 transfers and encoding overlap with inference
+runpod.serverless.start({"handler": async_handler(handler), "concurrency_modifier": concurrency_modifier})
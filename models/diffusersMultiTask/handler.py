@@ -0,0 +1,47 @@
+import importlib.util
+import os
+import sys
+import runpod
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.concurrency import async_handler, concurrency_modifier
+from common.residency import job_scope, residency_stats
+
+MODELS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Handlers this worker serves, picked per job with "task". Their pipelines share the
+# worker's memory: set MODEL_DEVICE_BUDGET_MB / MODEL_HOST_BUDGET_MB to keep the most
+# recently used ones resident and move the others to host RAM or drop them.
+TASKS = [task for task in os.environ.get(
+    "TASKS", "caricatureToRealImage,caricatureToRealImage_new,pix2pixImageInpainting").split(",") if task]
+
+
+# Import models/<task>/handler.py, which does not start a worker of its own when imported
+def import_task(task):
+    path = os.path.join(MODELS_DIR, task, "handler.py")
+    spec = importlib.util.spec_from_file_location(f"{task}_handler", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.handler
+
+
+task_handlers = {task: import_task(task) for task in TASKS}
+
+
+def handler(job):
+    task = job["input"].get("task")
+    if task not in task_handlers:
+        raise ValueError(f"Unsupported task {task}, expected one of: {', '.join(TASKS)}")
+
+    # The models this job loads stay where they are until it finishes
+    with job_scope():
+        output = task_handlers[task](job)
+
+    if isinstance(output, dict):
+        output["task"] = task
+        output["residency"] = residency_stats()
+    return output
+
+
+# Several jobs run at once so S3 transfers and encoding overlap with inference
+runpod.serverless.start({"handler": async_handler(handler), "concurrency_modifier": concurrency_modifier})
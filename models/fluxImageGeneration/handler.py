@@ -1,57 +1,145 @@
-import boto3
 import io
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image
 import runpod
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.encode import encode_image, image_format
+from common.concurrency import JOB_CONCURRENCY, async_handler, concurrency_modifier
+from common.result_cache import check_result_cache, store_result
+from common.s3 import get_s3_client
+from common.timing import Timings
+
+# HuggingFace API details
+API_URL = os.environ.get("HF_API_URL", "https://api-inference.huggingface.co/models/black-forest-labs/FLUX.1-schnell")
+
+# Prompts sent to the inference API at the same time, and the (connect, read) timeout in seconds
+MAX_CONCURRENT_REQUESTS = 4
+REQUEST_TIMEOUT = (10, 120)
+
+# Content types and output_format names for the image formats the API may return
+IMAGE_CONTENT_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+IMAGE_FORMAT_NAMES = {"image/png": "png", "image/jpeg": "jpeg", "image/webp": "webp"}
+
+
+# Keep-alive session shared by all jobs, retrying with backoff while the model is loading or rate limited.
+# Every concurrent job can have MAX_CONCURRENT_REQUESTS requests in flight, each needing its own connection.
+def create_session():
+    retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 503], allowed_methods=["POST"],
+                  respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=MAX_CONCURRENT_REQUESTS,
+                          pool_maxsize=JOB_CONCURRENCY * MAX_CONCURRENT_REQUESTS, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+session = create_session()
+
+
+# Check that the upstream bytes are an image we can upload as-is, and return its content type
+def image_content_type(image_bytes):
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            detected_format = image.format
+            image.verify()
+    except Exception:
+        detected_format = None
+    if detected_format in IMAGE_CONTENT_TYPES:
+        return IMAGE_CONTENT_TYPES[detected_format]
+    return None
+
+
+# Generate one image, upload it to S3 and return the presigned URL and encoding info for it.
+# output_format is None when the job did not ask for one, so the API's own bytes are kept.
+def generate_image(s3, bucket_name, output_key, hf_auth_token, hf_prompt, output_format, timings):
+    headers = {"Authorization": f"Bearer {hf_auth_token}"}
+
+    # Send the query to Hugging Face API through the shared session
+    with timings.span("inference"):
+        response = session.post(API_URL, headers=headers, json={"inputs": hf_prompt}, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+
+        # Read the response content
+        image_bytes = response.content
+
+    with timings.span("decode"):
+        content_type = image_content_type(image_bytes)
+
+    # Re-encode only when the API did not return an image format we can upload directly,
+    # or when the job asked for a different format than the one returned
+    if content_type is None or (output_format is not None and output_format.content_type != content_type):
+        output_format = output_format or image_format({})
+        image = Image.open(io.BytesIO(image_bytes))
+        image_bytes, encoded = encode_image(image, output_format)
+        timings.add("encode", encoded["encode_seconds"])
+        content_type = output_format.content_type
+    else:
+        encoded = {"format": IMAGE_FORMAT_NAMES[content_type], "bytes": len(image_bytes)}
+
+    # Upload the image to S3
+    with timings.span("s3_upload"):
+        s3.put_object(Bucket=bucket_name, Key=output_key, Body=image_bytes, ContentType=content_type)
+
+    # Generate a URL for the uploaded image in S3
+    with timings.span("presign"):
+        url = s3.generate_presigned_url('get_object',
+                                        Params={'Bucket': bucket_name, 'Key': output_key},
+                                        ExpiresIn=3600)
+    return url, encoded
+
 
 # Handler function to accept input and return the presigned URL of the output image
 def handler(job):
     job_input = job["input"]  # Access the input from the request
+    timings = Timings(job, "fluxImageGeneration")
     bucket_name = job_input["bucket_name"]
-    output_key = job_input["output_key"]
     aws_access_key_id = job_input["aws_access_key_id"]
     aws_secret_access_key = job_input["aws_secret_access_key"]
     aws_region = job_input["aws_region"]
     hf_auth_token = job_input["hf_auth_token"]  # API token for hugging face model
-    hf_prompt = job_input["hf_prompt"]  # Text prompt for hugging face model
     endpoint = job_input.get("endpoint", None)  # Optional custom endpoint URL
+    # Optional output_format / output_quality; without one the API's image is stored as returned
+    output_format = image_format(job_input) if "output_format" in job_input else None
 
-    # Set AWS credentials and region
-    os.environ['AWS_ACCESS_KEY_ID'] = aws_access_key_id
-    os.environ['AWS_SECRET_ACCESS_KEY'] = aws_secret_access_key
-    os.environ['AWS_DEFAULT_REGION'] = aws_region
+    # Reuse a pooled S3 client for these credentials and endpoint
+    s3 = get_s3_client(aws_access_key_id, aws_secret_access_key, aws_region, endpoint)
 
-    # Initialize S3 client with a custom endpoint if provided
-    s3 = boto3.client('s3', endpoint_url=endpoint)
+    # Several prompts can be generated concurrently with hf_prompts / output_keys
+    if "hf_prompts" in job_input:
+        hf_prompts = job_input["hf_prompts"]
+        output_keys = job_input["output_keys"]
+        if len(hf_prompts) != len(output_keys):
+            raise ValueError("hf_prompts and output_keys must have the same length")
 
-    # HuggingFace API details
-    API_URL = "https://api-inference.huggingface.co/models/black-forest-labs/FLUX.1-schnell"
-    headers = {"Authorization": f"Bearer {hf_auth_token}"}
-
-     # Send the query to Hugging Face API directly
-    response = requests.post(API_URL, headers=headers, json={"inputs": hf_prompt})
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as pool:
+            generated = pool.map(lambda args: generate_image(s3, bucket_name, args[1], hf_auth_token, args[0],
+                                                             output_format, timings),
+                                 zip(hf_prompts, output_keys))
+            images = [{"prompt": prompt, "output_key": output_key, "image_url": url, "encoding": encoded}
+                      for prompt, output_key, (url, encoded) in zip(hf_prompts, output_keys, generated)]
+        return {"images": images, "timings": timings.report()}
 
-    #if response.status_code == 200:
-    # Read the response content
-    image_bytes = response.content
-
-    # Load the image using PIL from the response bytes
-    image = Image.open(io.BytesIO(image_bytes))
+    hf_prompt = job_input["hf_prompt"]  # Text prompt for hugging face model
+    output_key = job_input["output_key"]
 
-    # Save the image into a BytesIO buffer
-    buffer = io.BytesIO()
-    image.save(buffer, format="PNG")
-    buffer.seek(0)
+    # Answer a repeated prompt from the result cache without calling the API
+    with timings.span("cache_lookup"):
+        cache_key, cached_url = check_result_cache(s3, job_input, output_key, "fluxImageGeneration",
+                                                   "black-forest-labs/FLUX.1-schnell", ())
+    if cached_url is not None:
+        return {"image_url": cached_url, "cache_hit": True, "timings": timings.report()}
 
-    # Upload the image to S3
-    s3.put_object(Bucket=bucket_name, Key=output_key, Body=buffer, ContentType='image/png')
+    image_url, encoded = generate_image(s3, bucket_name, output_key, hf_auth_token, hf_prompt, output_format, timings)
+    store_result(s3, cache_key, bucket_name, output_key)
+    return {"image_url": image_url, "cache_hit": False, "encoding": encoded, "timings": timings.report()}
 
-    # Generate a URL for the uploaded image in S3
-    response_url = s3.generate_presigned_url('get_object',
-                                              Params={'Bucket': bucket_name, 'Key': output_key},
-                                              ExpiresIn=3600)
-    return response_url
 
-runpod.serverless.start({"handler": handler})  # Required to start the serverless function
\ No newline at end of file
+# Several jobs run at once so their API calls and uploads overlap
+runpod.serverless.start({"handler": async_handler(handler), "concurrency_modifier": concurrency_modifier})  # Required to start the serverless function
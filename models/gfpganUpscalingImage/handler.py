@@ -1,61 +1,236 @@
 import os
+import sys
 import cv2
 import numpy as np
-import io
-import requests
 import runpod
-import boto3
+import tempfile
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from basicsr.utils import img2tensor, tensor2img
+from torchvision.transforms.functional import normalize
 from gfpgan.utils import GFPGANer
-# Helper function to download the GFPGAN model file
-def download_model(url, model_path):
-    if not os.path.exists(model_path):
-        print(f"Downloading {model_path}...")
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            with open(model_path, 'wb') as f:
-                f.write(response.content)
-            print(f"Model {model_path} downloaded successfully!")
-        else:
-            raise Exception(f"Failed to download {model_path} from {url}")
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.assets import ModelAssets
+from common.concurrency import async_handler, concurrency_modifier, inference_slot
+from common.residency import available_memory, model_state
+from common.encode import PNGWriter, image_format, upload_image
+from common.result_cache import check_result_cache, store_result
+from common.s3 import get_s3_client
+from common.timing import Timings
+from common.transfer import transfer_options, upload_file
+from common.video import chunked, prefetch
+
+# Weights listed in assets.json, baked into the image at build time
+assets = ModelAssets(os.path.dirname(os.path.abspath(__file__)))
+# facexlib looks for its detection and parsing weights under gfpgan/weights in the working directory
+FACEXLIB_ASSETS = ['gfpgan/weights/detection_Resnet50_Final.pth', 'gfpgan/weights/parsing_parsenet.pth']
+# Batch jobs: images whose faces are gathered together, and faces per forward pass
+IMAGES_PER_GROUP = 8
+DEFAULT_FACE_BATCH_SIZE = 16
+IO_WORKERS = 4
+# Tiled mode for large scans: horizontal strips with overlapping context, blended at the seams.
+# Bytes per output pixel covers the upscaled image plus the float masks built while pasting faces.
+BYTES_PER_OUTPUT_PIXEL = 80
+TILE_OVERLAP = 256
+BLEND_ROWS = 16
+DEFAULT_MEMORY_BUDGET_MB = int(os.environ.get("GFPGAN_MEMORY_BUDGET_MB", 4096))
+# Name the enhancer is kept under; its face helper is stateful, so every use holds the inference slot
+MODEL_NAME = "gfpgan-v1.4"
+# Initialize GFPGANer from the local weights
+def load_enhancer():
+    for path in FACEXLIB_ASSETS:
+        assets.path(path)
+    return GFPGANer(model_path=assets.path('GFPGANv1.4.pth'), upscale=2, arch='clean', channel_multiplier=2)
+# Load an image from S3 as a BGR numpy array
+def load_image(s3, bucket_name, key, timings):
+    with timings.span("s3_download"):
+        data = s3.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+    with timings.span("decode"):
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+# Detect and align the faces of one image, returning the crops and their affine matrices
+def detect_faces(face_enhancer, image):
+    helper = face_enhancer.face_helper
+    helper.clean_all()
+    helper.read_image(image)
+    helper.get_face_landmarks_5(only_center_face=False, eye_dist_threshold=5)
+    helper.align_warp_face()
+    return list(helper.cropped_faces), list(helper.affine_matrices)
+# Run aligned face crops through the GFPGAN net in batches
+def restore_faces(face_enhancer, crops, batch_size):
+    restored = []
+    for batch in chunked(crops, batch_size):
+        tensors = []
+        for crop in batch:
+            tensor = img2tensor(crop / 255., bgr2rgb=True, float32=True)
+            normalize(tensor, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+            tensors.append(tensor)
+        with torch.no_grad():
+            batch_tensor = torch.stack(tensors).to(face_enhancer.device)
+            output = face_enhancer.gfpgan(batch_tensor, return_rgb=False, weight=0.5)[0]
+        for face in output:
+            restored.append(tensor2img(face, rgb2bgr=True, min_max=(-1, 1)).astype('uint8'))
+    return restored
+# Paste restored faces back into their own (upscaled) image
+def paste_faces(face_enhancer, image, affine_matrices, restored):
+    helper = face_enhancer.face_helper
+    helper.clean_all()
+    helper.read_image(image)
+    helper.affine_matrices = affine_matrices
+    for face in restored:
+        helper.add_restored_face(face)
+    helper.get_inverse_affine(None)
+    return helper.paste_faces_to_input_image(upsample_img=None)
+# Rows of input per strip so one strip stays within the budget, or None when the whole image fits
+def plan_strips(height, width, upscale, budget):
+    row_cost = width * upscale * upscale * BYTES_PER_OUTPUT_PIXEL
+    if height * row_cost <= budget:
+        return None
+    return max(TILE_OVERLAP, budget // row_cost - 2 * TILE_OVERLAP)
+# Restore the faces of a strip that touch its core rows and paste them into the upscaled strip
+def enhance_strip(face_enhancer, strip, core_top, core_bottom):
+    helper = face_enhancer.face_helper
+    helper.clean_all()
+    helper.read_image(strip)
+    helper.get_face_landmarks_5(only_center_face=False, eye_dist_threshold=5)
+    # Faces outside the core are handled by the neighbouring strip
+    keep = [i for i, face in enumerate(helper.det_faces) if face[3] > core_top and face[1] < core_bottom]
+    helper.det_faces = [helper.det_faces[i] for i in keep]
+    helper.all_landmarks_5 = [helper.all_landmarks_5[i] for i in keep]
+    helper.align_warp_face()
+    crops, affine_matrices = list(helper.cropped_faces), list(helper.affine_matrices)
+    restored = restore_faces(face_enhancer, crops, DEFAULT_FACE_BATCH_SIZE)
+    return paste_faces(face_enhancer, strip, affine_matrices, restored), len(restored)
+# Enhance a large image strip by strip, streaming the upscaled rows into a PNG writer
+def enhance_tiled(face_enhancer, image, strip_rows, writer):
+    height = image.shape[0]
+    upscale = face_enhancer.upscale
+    previous_tail = None
+    strips = faces = 0
+    for top in range(0, height, strip_rows):
+        bottom = min(height, top + strip_rows)
+        strip_top = max(0, top - TILE_OVERLAP)
+        strip_bottom = min(height, bottom + TILE_OVERLAP)
+        output, face_count = enhance_strip(face_enhancer, image[strip_top:strip_bottom],
+                                           top - strip_top, bottom - strip_top)
+        core = output[(top - strip_top) * upscale:(bottom - strip_top) * upscale]
+        # Fade from the previous strip's rendering of the same rows into this one
+        if previous_tail is not None:
+            rows = previous_tail.shape[0]
+            ramp = np.linspace(0, 1, rows, dtype=np.float32)[:, None, None]
+            core[:rows] = (previous_tail * (1 - ramp) + core[:rows] * ramp).astype(np.uint8)
+        tail_start = (bottom - strip_top) * upscale
+        previous_tail = output[tail_start:tail_start + BLEND_ROWS * upscale].copy()
+        writer.write_rows(cv2.cvtColor(core, cv2.COLOR_BGR2RGB))
+        strips += 1
+        faces += face_count
+    return strips, faces
+# Restore many images, batching the faces of several images into each forward pass
+def enhance_batch(face_enhancer, s3, bucket_name, input_keys, output_keys, face_batch_size, output_format,
+                  timings):
+    results = []
+    with ThreadPoolExecutor(max_workers=IO_WORKERS) as pool:
+        # Download and decode the next group on the pool while the current one runs through the model
+        def load_groups():
+            for keys in chunked(zip(input_keys, output_keys), IMAGES_PER_GROUP):
+                images = pool.map(lambda key: load_image(s3, bucket_name, key, timings), [key for key, _ in keys])
+                yield [(input_key, output_key, image) for (input_key, output_key), image in zip(keys, images)]
+        uploads = []
+        for group in prefetch(load_groups(), depth=1):
+            with inference_slot(MODEL_NAME):
+                with timings.span("preprocess"):
+                    detected = [detect_faces(face_enhancer, image) for _, _, image in group]
+                with timings.span("inference"):
+                    restored = restore_faces(face_enhancer, [crop for crops, _ in detected for crop in crops],
+                                             face_batch_size)
+            for (input_key, output_key, image), (crops, affine_matrices) in zip(group, detected):
+                faces, restored = restored[:len(crops)], restored[len(crops):]
+                with inference_slot(MODEL_NAME), timings.span("postprocess"):
+                    output = paste_faces(face_enhancer, image, affine_matrices, faces)
+                # Encode and upload on the pool while the next image is processed
+                uploads.append((input_key, output_key, len(faces),
+                                pool.submit(upload_image, s3, bucket_name, output_key,
+                                            cv2.cvtColor(output, cv2.COLOR_BGR2RGB), output_format, timings)))
+        for input_key, output_key, face_count, upload in uploads:
+            image_url, encoded = upload.result()
+            results.append({"input_key": input_key, "output_key": output_key, "faces": face_count,
+                            "image_url": image_url, "encoding": encoded})
+    return results
 def handler(job):
     job_input = job["input"]
+    timings = Timings(job, "gfpganUpscalingImage")
     bucket_name = job_input["bucket_name"]
-    input_key = job_input["input_key"]
-    output_key = job_input["output_key"]
     aws_access_key_id = job_input["aws_access_key_id"]
     aws_secret_access_key = job_input["aws_secret_access_key"]
     aws_region = job_input["aws_region"]
     endpoint = job_input.get("endpoint", None)
-    # Set AWS credentials and region
-    os.environ['AWS_ACCESS_KEY_ID'] = aws_access_key_id
-    os.environ['AWS_SECRET_ACCESS_KEY'] = aws_secret_access_key
-    os.environ['AWS_DEFAULT_REGION'] = aws_region
-    # Initialize S3 client with a custom endpoint if provided
-    s3 = boto3.client('s3', endpoint_url=endpoint)
+    output_format = image_format(job_input)  # Optional output_format / output_quality, PNG by default
+    # Reuse a pooled S3 client for these credentials and endpoint
+    s3 = get_s3_client(aws_access_key_id, aws_secret_access_key, aws_region, endpoint)
+    # Single-image jobs are answered from the result cache without loading the model
+    cache_key = None
+    if "input_keys" not in job_input:
+        with timings.span("cache_lookup"):
+            cache_key, cached_url = check_result_cache(s3, job_input, job_input["output_key"], "gfpganUpscalingImage",
+                                                       "GFPGANv1.4")
+        if cached_url is not None:
+            return {"image_url": cached_url, "cache_hit": True, "timings": timings.report()}
+    # Reuse the enhancer kept by this worker
+    face_enhancer, warm = timings.load_resident(MODEL_NAME, load_enhancer)
+    # Batch jobs restore many images given as input_keys / output_keys
+    if "input_keys" in job_input:
+        input_keys = job_input["input_keys"]
+        output_keys = job_input["output_keys"]
+        if len(input_keys) != len(output_keys):
+            raise ValueError("input_keys and output_keys must have the same length")
+        face_batch_size = int(job_input.get("face_batch_size", DEFAULT_FACE_BATCH_SIZE))
+        images = enhance_batch(face_enhancer, s3, bucket_name, input_keys, output_keys, face_batch_size,
+                               output_format, timings)
+        return {"images": images, "model_state": model_state(warm), "timings": timings.report()}
+    input_key = job_input["input_key"]
+    output_key = job_input["output_key"]
     # Load the image from S3
-    response = s3.get_object(Bucket=bucket_name, Key=input_key)
-    image_data = response['Body'].read()
-    image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
-
-    # Paths for the model
-    gfpgan_model_url = 'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.4.pth'
-    gfpgan_model_path = 'GFPGANv1.4.pth'
-
-    # Download the GFPGAN model if it doesn't exist
-    download_model(gfpgan_model_url, gfpgan_model_path)
-    # Initialize GFPGANer with the model
-    face_enhancer = GFPGANer(
-        model_path=gfpgan_model_path, upscale=2, arch='clean', channel_multiplier=2)
+    image = load_image(s3, bucket_name, input_key, timings)
+    # Large images are processed in strips that fit the memory budget
+    budget = int(job_input.get("memory_budget_mb", DEFAULT_MEMORY_BUDGET_MB)) * 1024 * 1024
+    memory = available_memory()
+    if memory:
+        budget = min(budget, memory // 2)
+    height, width = image.shape[:2]
+    strip_rows = plan_strips(height, width, face_enhancer.upscale, budget)
+    if strip_rows is not None:
+        # Strips are streamed into a PNG, so other formats cannot be written this way
+        if output_format.name != "png":
+            raise ValueError(f"Image of {width}x{height} is too large for {output_format.name} output within "
+                             f"the memory budget, use output_format png or a larger memory_budget_mb")
+        upscale = face_enhancer.upscale
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_path = os.path.join(tmpdir, "output.png")
+            with open(output_path, "wb") as f:
+                writer = PNGWriter(f, width * upscale, height * upscale, compress_level=output_format.quality)
+                # PNG encoding is streamed strip by strip, so it is counted with inference here
+                with inference_slot(MODEL_NAME), timings.span("inference"):
+                    strips, faces = enhance_tiled(face_enhancer, image, strip_rows, writer)
+                with timings.span("encode"):
+                    writer.close()
+            encoded = {"format": "png", "bytes": os.path.getsize(output_path)}
+            with timings.span("s3_upload"):
+                upload_file(s3, bucket_name, output_key, output_path, 'image/png', **transfer_options(job_input))
+        store_result(s3, cache_key, bucket_name, output_key)
+        with timings.span("presign"):
+            response = s3.generate_presigned_url('get_object',
+                                                 Params={'Bucket': bucket_name,
+                                                         'Key': output_key}, ExpiresIn=3600)
+        return {"image_url": response, "model_state": model_state(warm), "cache_hit": False,
+                "tiles": strips, "faces": faces, "encoding": encoded, "timings": timings.report()}
     # Enhance the image using GFPGAN
-    _, _, output = face_enhancer.enhance(image, has_aligned=False, only_center_face=False, paste_back=True)
-    # Save the output image to a buffer
-    _, buffer = cv2.imencode('input.png', output)
-    buffer = io.BytesIO(buffer)
-    # Save the output image back to S3
-    s3.put_object(Bucket=bucket_name, Key=output_key, Body=buffer.getvalue(), ContentType='image/png')
-    # Return presigned URL for the output image
-    response = s3.generate_presigned_url('get_object',
-                                         Params={'Bucket': bucket_name,
-                                                 'Key': output_key}, ExpiresIn=3600)
-    return response
-runpod.serverless.start({"handler": handler})
+    with inference_slot(MODEL_NAME), timings.span("inference"):
+        _, _, output = face_enhancer.enhance(image, has_aligned=False, only_center_face=False, paste_back=True)
+    # Save the output image back to S3 and return its presigned URL
+    response, encoded = upload_image(s3, bucket_name, output_key, cv2.cvtColor(output, cv2.COLOR_BGR2RGB),
+                                     output_format, timings)
+    store_result(s3, cache_key, bucket_name, output_key)
+    return {"image_url": response, "model_state": model_state(warm), "cache_hit": False,
+            "encoding": encoded, "timings": timings.report()}
+# Several jobs run at once so S3 transfers and encoding overlap with inference
+runpod.serverless.start({"handler": async_handler(handler), "concurrency_modifier": concurrency_modifier})
@@ -2,16 +2,285 @@ import cv2
 import numpy as np
 from PIL import Image
 from diffusers import StableVideoDiffusionPipeline
-from diffusers.utils import load_image, export_to_video
+from diffusers.utils import load_image
 import torch
-import boto3
 import io
+import math
 import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import runpod
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.assets import ModelAssets
+from common.concurrency import async_handler, concurrency_modifier, inference_slot
+from common.residency import available_memory, model_state
+from common.result_cache import check_result_cache, store_result
+from common.s3 import get_s3_client
+from common.timing import Timings
+
+from common.transfer import transfer_options, upload_file
+from common.video import VideoWriter
+
+# Weights listed in assets.json, baked into the image at build time
+assets = ModelAssets(os.path.dirname(os.path.abspath(__file__)))
+
+MODEL_NAME = "stable-video-diffusion-img2vid-xt"
+MB = 1024 * 1024
+
+# Rough fp16 memory figures for SVD-XT, used to plan a job. Weights kept on the
+# device per offload strategy, UNet activations per latent pixel and frame
+# (classifier-free guidance included) and VAE decode memory per output pixel
+# of a decode chunk.
+OFFLOAD_STRATEGIES = ("none", "model", "sequential")
+DEVICE_WEIGHTS_MB = {"none": 4700, "model": 3100, "sequential": 600}
+UNET_BYTES_PER_LATENT = 20 * 1024
+VAE_BYTES_PER_PIXEL = 800
+# Decoded frames of one chunk held on the host, as float arrays and again as uint8
+HOST_BYTES_PER_PIXEL = 16
+# Share of the device memory a plan may use
+DEVICE_HEADROOM = 0.9
+
+# Job "quality" targets: candidate sizes and frame counts, best first, the
+# denoising steps, the largest decode chunk and the offload strategies allowed
+# before the size or frame count is lowered.
+QUALITY_TARGETS = {
+    "quality": {"sizes": [(1024, 576), (896, 504), (768, 432)], "frames": [25, 14], "steps": 25,
+                "max_chunk": 25, "offloads": ("none", "model", "sequential")},
+    "balanced": {"sizes": [(1024, 576), (768, 432), (512, 288)], "frames": [25, 14], "steps": 25,
+                 "max_chunk": 8, "offloads": ("none", "model")},
+    "latency": {"sizes": [(768, 432), (512, 288)], "frames": [14], "steps": 15,
+                "max_chunk": 14, "offloads": ("none",)},
+}
+DEFAULT_QUALITY = "balanced"
+DECODE_CHUNK_SIZES = (25, 14, 8, 4, 2, 1)
+FPS = 7
+
+# Plan fields that change the generated video, and so the result cache key
+PLAN_OUTPUT_FIELDS = ("width", "height", "num_frames", "decode_chunk_size", "num_inference_steps")
+
+# Progressive mode: frames are published as MPEG-TS segments of at least this many
+# frames behind an HLS event playlist, with at most MAX_PENDING_SEGMENTS waiting for upload
+SEGMENT_FRAMES = FPS
+MAX_PENDING_SEGMENTS = 2
+SEGMENT_CODEC_ARGS = ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-f', 'mpegts']
+
+
+# Load StableVideoDiffusionPipeline from Hugging Face, on the host until a plan picks an offload strategy
+def load_pipeline():
+    return StableVideoDiffusionPipeline.from_pretrained(
+        assets.repo("stabilityai/stable-video-diffusion-img2vid-xt"), torch_dtype=torch.float16, variant="fp16"
+    )
+
+
+# Device memory this worker's pipeline can use: what is free plus what torch already holds for it
+def device_memory():
+    if not torch.cuda.is_available():
+        return None
+    free, _ = torch.cuda.mem_get_info()
+    return int((free + torch.cuda.memory_reserved()) * DEVICE_HEADROOM)
+
+
+def estimate_device_bytes(width, height, num_frames, decode_chunk_size, offload):
+    unet = width * height // 64 * num_frames * UNET_BYTES_PER_LATENT
+    vae = width * height * decode_chunk_size * VAE_BYTES_PER_PIXEL
+    return DEVICE_WEIGHTS_MB[offload] * MB + max(unet, vae)
+
+
+def plan_video(job_input, device_budget, host_budget):
+    """
+    Pick size, num_frames, decode_chunk_size, denoising steps and offload strategy
+    for the job's quality target within the device and host memory budgets.
+    Parameters set in the job are kept as given; the others are searched best
+    first, preferring cheaper offloading over larger decode chunks. Without a
+    CUDA device there is nothing to plan for and the best candidate is used.
+    """
+    quality = job_input.get("quality", DEFAULT_QUALITY)
+    if quality not in QUALITY_TARGETS:
+        raise ValueError(f"Unsupported quality {quality}, expected one of: {', '.join(QUALITY_TARGETS)}")
+    target = QUALITY_TARGETS[quality]
+
+    sizes = target["sizes"]
+    if "width" in job_input or "height" in job_input:
+        sizes = [(int(job_input.get("width", sizes[0][0])), int(job_input.get("height", sizes[0][1])))]
+        if sizes[0][0] % 8 or sizes[0][1] % 8:
+            raise ValueError("width and height must be multiples of 8")
+    frame_counts = [int(job_input["num_frames"])] if "num_frames" in job_input else target["frames"]
+    offloads = target["offloads"]
+    if "offload" in job_input:
+        if job_input["offload"] not in OFFLOAD_STRATEGIES:
+            raise ValueError(f"Unsupported offload {job_input['offload']}, "
+                             f"expected one of: {', '.join(OFFLOAD_STRATEGIES)}")
+        offloads = (job_input["offload"],)
+    elif device_budget is None:
+        offloads = ("none",)
+    steps = int(job_input.get("num_inference_steps", target["steps"]))
+
+    candidates = []
+    for width, height in sizes:
+        for num_frames in frame_counts:
+            if "decode_chunk_size" in job_input:
+                chunks = [int(job_input["decode_chunk_size"])]
+            else:
+                chunks = [c for c in DECODE_CHUNK_SIZES if c <= min(num_frames, target["max_chunk"])] or [1]
+            for offload in offloads:
+                for chunk in chunks:
+                    candidates.append((width, height, num_frames, chunk, offload))
+
+    def fits(candidate):
+        width, height, _, chunk, _ = candidate
+        if host_budget is not None and width * height * chunk * HOST_BYTES_PER_PIXEL > host_budget:
+            return False
+        return device_budget is None or estimate_device_bytes(*candidate) <= device_budget
+
+    # Nothing fits: the smallest candidate, with sequential offload unless the job set one, is the last resort
+    fitting = [candidate for candidate in candidates if fits(candidate)]
+    if fitting:
+        width, height, num_frames, chunk, offload = fitting[0]
+    else:
+        width, height, num_frames, chunk, offload = candidates[-1]
+        if "offload" not in job_input and device_budget is not None:
+            offload = "sequential"
+    return {
+        "quality": quality,
+        "width": width,
+        "height": height,
+        "num_frames": num_frames,
+        "decode_chunk_size": chunk,
+        "num_inference_steps": steps,
+        "offload": offload,
+        "fits": bool(fitting),
+        "estimated_device_mb": round(estimate_device_bytes(width, height, num_frames, chunk, offload) / MB),
+        "device_budget_mb": round(device_budget / MB) if device_budget is not None else None,
+        "host_budget_mb": round(host_budget / MB) if host_budget is not None else None,
+    }
+
+
+# Move the resident pipeline to the plan's offload strategy, if it is not there already.
+# Callers hold the inference slot, so no other job is using the pipeline meanwhile.
+def apply_offload(pipeline, offload):
+    if not torch.cuda.is_available() or getattr(pipeline, "offload_strategy", None) == offload:
+        return False
+    if offload == "none":
+        pipeline.remove_all_hooks()
+        pipeline.to("cuda")
+    elif offload == "model":
+        pipeline.enable_model_cpu_offload()
+    else:
+        pipeline.enable_sequential_cpu_offload()
+    pipeline.offload_strategy = offload
+    return True
+
+
+# Decode the latents of a video one chunk at a time, yielding uint8 RGB frames of shape (n, h, w, 3),
+# so the whole decoded video is never held at once
+def decode_frames(pipeline, latents, decode_chunk_size, timings):
+    for start in range(0, latents.shape[1], decode_chunk_size):
+        with timings.span("vae_decode"):
+            chunk = latents[:, start:start + decode_chunk_size]
+            with torch.no_grad():
+                frames = pipeline.decode_latents(chunk, chunk.shape[1], decode_chunk_size)
+            # (batch, channels, frames, h, w) in [-1, 1] to (frames, h, w, channels) in [0, 255]
+            frames = (frames[0].permute(1, 2, 3, 0) / 2 + 0.5).clamp(0, 1)
+            yield (frames * 255).round().to(torch.uint8).cpu().numpy()
+
+
+class SegmentPublisher:
+    """
+    Publish frames as an HLS event playlist while they are being generated.
+
+    Frames are grouped into MPEG-TS segments of at least SEGMENT_FRAMES frames.
+    Each segment is encoded and uploaded on a background thread, then the
+    playlist is rewritten to list it, so players can start before the last
+    frame is decoded. Segments are listed by presigned URL, so the playlist
+    also plays from private buckets. close() appends EXT-X-ENDLIST.
+    """
+
+    def __init__(self, s3, bucket_name, playlist_key, decode_chunk_size, tmpdir, timings, on_segment=None):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.playlist_key = playlist_key
+        self.segment_prefix = os.path.splitext(playlist_key)[0]
+        self.tmpdir = tmpdir
+        self.timings = timings
+        self.on_segment = on_segment
+        # Segments hold SEGMENT_FRAMES plus at most one chunk less a frame
+        self.target_duration = math.ceil((SEGMENT_FRAMES + decode_chunk_size - 1) / FPS)
+        self.frames = []
+        self.frames_published = 0
+        self.segments = []
+        self.uploads = []
+        self.uploader = ThreadPoolExecutor(max_workers=1)
+
+    def write(self, frames):
+        self.frames.extend(frames)
+        if len(self.frames) >= SEGMENT_FRAMES:
+            self._flush()
+
+    def _flush(self):
+        frames, self.frames = self.frames, []
+        start = self.frames_published
+        self.frames_published += len(frames)
+        self.uploads.append(self.uploader.submit(self._publish, len(self.uploads), start, frames))
+        # Keep the frames waiting for upload bounded
+        if len(self.uploads) > MAX_PENDING_SEGMENTS:
+            self.uploads[-MAX_PENDING_SEGMENTS - 1].result()
+
+    def _publish(self, index, start, frames):
+        path = os.path.join(self.tmpdir, f"segment_{index:05d}.ts")
+        key = f"{self.segment_prefix}_{index:05d}.ts"
+        # Timestamps continue from the previous segment
+        with self.timings.span("encode"):
+            codec_args = SEGMENT_CODEC_ARGS + ['-output_ts_offset', f"{start / FPS:.3f}"]
+            with VideoWriter(path, FPS, codec_args=codec_args) as writer:
+                for frame in frames:
+                    writer.write(frame)
+        with self.timings.span("s3_upload"):
+            with open(path, "rb") as f:
+                self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=f, ContentType='video/mp2t')
+        os.remove(path)
+        with self.timings.span("presign"):
+            url = self.s3.generate_presigned_url('get_object',
+                                                 Params={'Bucket': self.bucket_name, 'Key': key}, ExpiresIn=3600)
+        self.segments.append((len(frames) / FPS, url))
+        self._write_playlist(final=False)
+        if self.on_segment is not None:
+            self.on_segment(len(self.segments))
+
+    def _write_playlist(self, final):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{self.target_duration}",
+                 "#EXT-X-MEDIA-SEQUENCE:0", "#EXT-X-PLAYLIST-TYPE:EVENT"]
+        for duration, url in self.segments:
+            lines += [f"#EXTINF:{duration:.3f},", url]
+        if final:
+            lines.append("#EXT-X-ENDLIST")
+        with self.timings.span("s3_upload"):
+            self.s3.put_object(Bucket=self.bucket_name, Key=self.playlist_key, Body="\n".join(lines) + "\n",
+                               ContentType='application/vnd.apple.mpegurl', CacheControl='no-cache')
+
+    def close(self):
+        if self.frames:
+            self._flush()
+        for upload in self.uploads:
+            upload.result()
+        self.uploader.shutdown()
+        self._write_playlist(final=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.uploader.shutdown(cancel_futures=True)
+
+
 def handler(job):
     # Extract inputs from the job
     job_input = job["input"]
+    timings = Timings(job, "imageToVideo")
     bucket_name = job_input["bucket_name"]
     input_key = job_input["input_key"]
     output_key = job_input["output_key"]
@@ -20,50 +289,105 @@ def handler(job):
     aws_region = job_input["aws_region"]
     endpoint = job_input.get("endpoint", None)
 
-    # Set AWS credentials
-    os.environ['AWS_ACCESS_KEY_ID'] = aws_access_key_id
-    os.environ['AWS_SECRET_ACCESS_KEY'] = aws_secret_access_key
-    os.environ['AWS_DEFAULT_REGION'] = aws_region
+    # Reuse a pooled S3 client for these credentials and endpoint
+    s3 = get_s3_client(aws_access_key_id, aws_secret_access_key, aws_region, endpoint)
+
+    # Plan the video for this worker's memory; the plan decides the output, so it is part of the cache key
+    with timings.span("preprocess"):
+        device_budget = device_memory()
+        if "memory_budget_mb" in job_input and device_budget is not None:
+            device_budget = min(device_budget, int(job_input["memory_budget_mb"]) * MB)
+        host_budget = available_memory()
+        plan = plan_video(job_input, device_budget, host_budget // 2 if host_budget else None)
 
-    # Initialize S3 client
-    s3 = boto3.client('s3', endpoint_url=endpoint)
+    # Answer repeated work from the result cache without loading any model
+    with timings.span("cache_lookup"):
+        cache_key, cached_url = check_result_cache(s3, job_input, output_key, "imageToVideo", "stabilityai/stable-video-diffusion-img2vid-xt",
+                                                   resolved={field: plan[field] for field in PLAN_OUTPUT_FIELDS})
+    if cached_url is not None:
+        return {"video_url": cached_url, "cache_hit": True, "plan": plan, "timings": timings.report()}
 
     # Load the image from S3
-    response = s3.get_object(Bucket=bucket_name, Key=input_key)
-    image_data = response['Body'].read()
-    image = Image.open(io.BytesIO(image_data))
-    image = Image.open(io.BytesIO(image_data)).convert("RGB")
+    with timings.span("s3_download"):
+        response = s3.get_object(Bucket=bucket_name, Key=input_key)
+        image_data = response['Body'].read()
+    with timings.span("decode"):
+        image = Image.open(io.BytesIO(image_data)).convert("RGB")
 
-    # Resize image to the expected dimensions
-    image = image.resize((1024, 576))
+    # Resize the image to the planned dimensions
+    with timings.span("preprocess"):
+        image = image.resize((plan["width"], plan["height"]))
 
-    # Load StableVideoDiffusionPipeline from Hugging Face
-    pipeline = StableVideoDiffusionPipeline.from_pretrained(
-        "stabilityai/stable-video-diffusion-img2vid-xt", torch_dtype=torch.float16, variant="fp16"
-    )
-    pipeline.enable_model_cpu_offload()
+    # Reuse the pipeline kept by this worker, loading it on the first job only
+    pipeline, warm = timings.load_resident(MODEL_NAME, load_pipeline)
 
-    # Set the seed for reproducibility
-    generator = torch.manual_seed(42)
+    # Set the seed for reproducibility, on a generator of this job's own
+    generator = torch.Generator().manual_seed(int(job_input.get("seed", 42)))
 
-    # Generate video frames
-    frames = pipeline(image, decode_chunk_size=8, generator=generator).frames[0]
+    # With "progressive", output_key is an HLS playlist that grows segment by segment while frames are
+    # decoded; its URL is sent as a progress update before the first segment, so playback can start early
+    progressive = bool(job_input.get("progressive", False))
+    with timings.span("presign"):
+        response = s3.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket_name, 'Key': output_key},
+            ExpiresIn=3600
+        )
 
-    # Export the generated frames to a video
-    video_path = "/tmp/generated_video.mp4"
-    export_to_video(frames, video_path, fps=7)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        video_path = os.path.join(tmpdir, "generated_video.mp4")
+        if progressive:
+            runpod.serverless.progress_update(job, {"playlist_url": response, "segments": 0})
+            writer = SegmentPublisher(s3, bucket_name, output_key, plan["decode_chunk_size"], tmpdir, timings,
+                                      lambda count: runpod.serverless.progress_update(
+                                          job, {"playlist_url": response, "segments": count}))
+        else:
+            writer = VideoWriter(video_path, FPS)
 
-    # Upload the generated video to S3
-    with open(video_path, "rb") as video_file:
-        s3.put_object(Bucket=bucket_name, Key=output_key, Body=video_file, ContentType='video/mp4')
+        # Denoise, one job at a time on the pipeline, then decode chunk by chunk straight into the writer.
+        # The writer finishes its last segment or the file after the pipeline is released.
+        with writer:
+            with inference_slot(MODEL_NAME):
+                with timings.span("offload") as info:
+                    info["cold"] = apply_offload(pipeline, plan["offload"])
+                with timings.span("inference"):
+                    latents = pipeline(image, height=plan["height"], width=plan["width"],
+                                       num_frames=plan["num_frames"], decode_chunk_size=plan["decode_chunk_size"],
+                                       num_inference_steps=plan["num_inference_steps"], generator=generator,
+                                       output_type="latent").frames
+                for frames in decode_frames(pipeline, latents, plan["decode_chunk_size"], timings):
+                    if progressive:
+                        writer.write(frames)
+                    else:
+                        with timings.span("encode"):
+                            for frame in frames:
+                                writer.write(frame)
 
-    # Generate a presigned URL to access the video
-    response = s3.generate_presigned_url(
-        'get_object', 
-        Params={'Bucket': bucket_name, 'Key': output_key}, 
-        ExpiresIn=3600
-    )
+        if progressive:
+            # Segment URLs in the playlist expire, so progressive results are not cached
+            return {
+                "video_url": response,
+                "playlist_url": response,
+                "segments": len(writer.segments),
+                "model_state": model_state(warm),
+                "cache_hit": False,
+                "plan": plan,
+                "timings": timings.report()
+            }
+
+        # Upload the generated video to S3 in concurrent multipart parts
+        with timings.span("s3_upload"):
+            upload_stats = upload_file(s3, bucket_name, output_key, video_path, 'video/mp4', **transfer_options(job_input))
+            store_result(s3, cache_key, bucket_name, output_key)
 
-    return response
+    return {
+        "video_url": response,
+        "model_state": model_state(warm),
+        "transfers": [upload_stats],
+        "cache_hit": False,
+        "plan": plan,
+        "timings": timings.report()
+    }
 
-runpod.serverless.start({"handler": handler})
+# Several jobs run at once so S3 transfers and encoding overlap with inference
+runpod.serverless.start({"handler": async_handler(handler), "concurrency_modifier": concurrency_modifier})
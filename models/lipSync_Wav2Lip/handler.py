@@ -1,92 +1,291 @@
 import os
-import boto3
 import torch
 import cv2
 import numpy as np
-import subprocess
 import runpod
-import requests
 import librosa
+from scipy import signal
 from moviepy.editor import VideoFileClip
 import tempfile
+import sys
 
-# Ensure the Wav2Lip model is correctly imported
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.assets import ModelAssets, load_state_dict, sha256_file
+from common.lru import LRUCache
+from common.result_cache import check_result_cache, store_result
+from common.s3 import get_s3_client
+from common.timing import Timings
+from common.transfer import download_file, transfer_options, upload_file
+from common.video import VideoWriter, chunked, prefetch
+
+# Ensure the Wav2Lip model and its face detector are correctly imported.
+# face_detection imports its detectors by top-level name, so the repo goes on the path.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Wav2Lip"))
 try:
     from Wav2Lip.models.wav2lip import Wav2Lip
+    import face_detection
 except ImportError as e:
     print(f"Failed to import Wav2Lip: {e}")
 
-# Define the model URL and path
-wav2lip_model_url = 'https://iiitaphyd-my.sharepoint.com/:u:/g/personal/radrabha_m_research_iiit_ac_in/Eb3LEzbfuKlJiR600lQWRxgBIY27JZg80f7V9jtMfbNDaQ?e=TBFBVW'
-wav2lip_model_path = 'wav2lip.pth'
-
-# Function to download the model if not present
-def download_model(url, save_path):
-    if not os.path.exists(save_path):
-        print(f"Downloading Wav2Lip model to {save_path}...")
-        response = requests.get(url, stream=True)
-        with open(save_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-        print("Download completed.")
-    else:
-        print(f"Model already exists at {save_path}.")
-
-download_model(wav2lip_model_url, wav2lip_model_path)
-
-# Function to load the model from a .pth file
-def load_model_from_pth(path):
+# Weights listed in assets.json, baked into the image at build time.
+# The checkpoint is stored as safetensors, so loading it memory-maps the file.
+assets = ModelAssets(os.path.dirname(os.path.abspath(__file__)))
+
+# Function to load the model from its local weights
+def load_model():
     model = Wav2Lip()
-    checkpoint = torch.load(path, map_location=torch.device('cpu'), weights_only=False)
-    model.load_state_dict(checkpoint['state_dict'])
+    model.load_state_dict(load_state_dict(assets.path('wav2lip.safetensors')))
     return model.eval()
 
-# Function to preprocess audio into mel spectrogram
-def preprocess_mel(audio, sample_rate):
-    mel = librosa.feature.melspectrogram(y=audio, sr=sample_rate, n_fft=400, hop_length=160, n_mels=80)
-    mel = np.log(mel + 1e-5)
-    mel = np.expand_dims(mel, axis=0)
-    return mel
+# Function to load the S3FD face detector, which reads its weights from inside the Wav2Lip repo
+def load_detector(device):
+    assets.path('Wav2Lip/face_detection/detection/sfd/s3fd.pth')
+    return face_detection.FaceAlignment(face_detection.LandmarksType._2D, flip_input=False, device=device)
+
+# Wav2Lip works on 96x96 faces and 16 mel steps of audio per video frame
+IMG_SIZE = 96
+MEL_STEP_SIZE = 16
+
+# Mel spectrogram settings Wav2Lip was trained with (its hparams.py): 80 mel steps per second
+AUDIO_SAMPLE_RATE = 16000
+MEL_N_FFT = 800
+MEL_HOP_LENGTH = 200
+MEL_WIN_LENGTH = 800
+MEL_BANDS = 80
+MEL_FMIN = 55
+MEL_FMAX = 7600
+PREEMPHASIS = 0.97
+REF_LEVEL_DB = 20
+MIN_LEVEL_DB = -100
+MAX_ABS_VALUE = 4.
+mel_basis = librosa.filters.mel(sr=AUDIO_SAMPLE_RATE, n_fft=MEL_N_FFT, n_mels=MEL_BANDS, fmin=MEL_FMIN,
+                                fmax=MEL_FMAX)
+
+# Mel spectrograms of input audio, keyed by the SHA-256 of the audio file, so one voice
+# track applied to several videos is decoded and transformed once
+MEL_CACHE_SIZE = int(os.environ.get("WAV2LIP_MEL_CACHE_SIZE", 32))
+mel_cache = LRUCache(MEL_CACHE_SIZE)
+
+# Batch sizing: the per-sample estimate covers activations of a 96x96 forward pass
+DEFAULT_CPU_BATCH_SIZE = 16
+MAX_BATCH_SIZE = 256
+BYTES_PER_SAMPLE = 24 * 1024 * 1024
+
+# Frames decoded, synced and encoded together; bounds the memory used by a job
+CHUNK_SIZE = 256
+# Frames decoded ahead of the chunk being gathered, enough to keep the decoder busy
+PREFETCH_FRAMES = 4
+
+# Face regions: S3FD runs on every DEFAULT_DETECT_EVERY-th frame, the boxes in between are
+# interpolated and then smoothed over SMOOTHING_WINDOW frames. Crops are padded by
+# FACE_PADS (top, bottom, left, right) so the chin stays in the crop.
+DEFAULT_DETECT_EVERY = 5
+SMOOTHING_WINDOW = 5
+FACE_PADS = (0, 10, 0, 0)
+DETECT_BATCH_SIZE = 16
+
+# Face boxes of input videos, keyed by the video object's ETag and the detection stride,
+# so re-dubbing a video with new audio skips detection
+FACE_BOX_CACHE_SIZE = int(os.environ.get("WAV2LIP_FACE_CACHE_SIZE", 64))
+face_box_cache = LRUCache(FACE_BOX_CACHE_SIZE)
+
+# Function to preprocess 16 kHz audio into a normalized log-mel spectrogram of shape (80, steps),
+# the same as Wav2Lip's audio.melspectrogram, whose librosa calls no longer run on current librosa
+def preprocess_mel(audio):
+    emphasized = signal.lfilter([1, -PREEMPHASIS], [1], audio)
+    # Older librosa, which Wav2Lip used, padded the signal by reflection
+    spectrum = np.abs(librosa.stft(y=emphasized, n_fft=MEL_N_FFT, hop_length=MEL_HOP_LENGTH,
+                                   win_length=MEL_WIN_LENGTH, pad_mode='reflect'))
+    min_level = np.exp(MIN_LEVEL_DB / 20 * np.log(10))
+    mel_db = 20 * np.log10(np.maximum(min_level, np.dot(mel_basis, spectrum))) - REF_LEVEL_DB
+    # Symmetric normalization to [-MAX_ABS_VALUE, MAX_ABS_VALUE]
+    normalized = 2 * MAX_ABS_VALUE * ((mel_db - MIN_LEVEL_DB) / -MIN_LEVEL_DB) - MAX_ABS_VALUE
+    return np.clip(normalized, -MAX_ABS_VALUE, MAX_ABS_VALUE).astype(np.float32)
+
+# Function to view a mel spectrogram as one MEL_STEP_SIZE window per mel step,
+# shaped (positions, 80, MEL_STEP_SIZE) and sharing memory with the spectrogram
+def mel_window_view(mel):
+    if mel.shape[1] < MEL_STEP_SIZE:
+        # Audio shorter than one window: repeat its last step
+        mel = np.pad(mel, ((0, 0), (0, MEL_STEP_SIZE - mel.shape[1])), mode='edge')
+    return np.lib.stride_tricks.sliding_window_view(mel, MEL_STEP_SIZE, axis=1).transpose(1, 0, 2)
+
+# Function to run the detector on a batch of BGR frames, halving the batch when the GPU runs out of memory
+def detect_batch(detector, frames):
+    batch_size = len(frames)
+    while True:
+        try:
+            detections = []
+            for start in range(0, len(frames), batch_size):
+                detections.extend(detector.get_detections_for_batch(np.array(frames[start:start + batch_size])))
+            return detections
+        except RuntimeError as e:
+            if 'out of memory' not in str(e) or batch_size == 1:
+                raise
+            torch.cuda.empty_cache()
+            batch_size = max(1, batch_size // 2)
+
+# Function to detect faces on every `stride`-th frame of a video.
+# Returns the frame count and the indices and (x1, y1, x2, y2) boxes of the frames with a face.
+def detect_faces(detector, video_path, stride):
+    indices, boxes, pending = [], [], []
+
+    def flush():
+        for (index, _), box in zip(pending, detect_batch(detector, [frame for _, frame in pending])):
+            if box is not None:
+                indices.append(index)
+                boxes.append(box[:4])
+        pending.clear()
 
-def model_inference(frames, mel_spectrogram, model, device='cpu'):
-    synced_frames = []
+    capture = cv2.VideoCapture(video_path)
+    frame_count = 0
+    try:
+        # Skipped frames are only grabbed, not converted
+        while capture.grab():
+            if frame_count % stride == 0:
+                ok, frame = capture.retrieve()
+                if ok:
+                    pending.append((frame_count, frame))
+            frame_count += 1
+            if len(pending) == DETECT_BATCH_SIZE:
+                flush()
+        flush()
+    finally:
+        capture.release()
+    return frame_count, indices, boxes
 
-    # Send model to device (GPU or CPU)
-    model = model.to(device)
+# Function to turn sparse detections into one box per frame: linear interpolation between
+# detections (held at both ends), then a centered moving average against jitter
+def track_faces(frame_count, indices, boxes, window=SMOOTHING_WINDOW):
+    if not indices:
+        raise ValueError("No face was detected in the video")
+    boxes = np.asarray(boxes, dtype=np.float64)
+    track = np.stack([np.interp(np.arange(frame_count), indices, boxes[:, k]) for k in range(4)], axis=1)
+    if window > 1 and frame_count > 1:
+        padded = np.pad(track, ((window // 2, window - 1 - window // 2), (0, 0)), mode='edge')
+        kernel = np.ones(window) / window
+        track = np.stack([np.convolve(padded[:, k], kernel, mode='valid') for k in range(4)], axis=1)
+    return np.rint(track).astype(np.int32)
 
-    # Process each frame (batch inference is possible but keeping it simple here)
-    for frame in frames:
-        # Resize and normalize the frame
-        frame = cv2.resize(frame, (96, 96))  # Wav2Lip uses 96x96 frames
-        frame = np.float32(frame) / 255.0    # Normalize frame
-        frame = np.transpose(frame, (2, 0, 1))  # Convert to channel-first (C, H, W)
-        frame = torch.FloatTensor(frame).unsqueeze(0).to(device)  # Add batch dimension and send to device
+# Function to pad a face box and clip it to the frame
+def face_region(box, frame_shape, pads=FACE_PADS):
+    top, bottom, left, right = pads
+    height, width = frame_shape[:2]
+    x1, y1, x2, y2 = (int(v) for v in box)
+    x1, y1 = min(max(0, x1 - left), width - 1), min(max(0, y1 - top), height - 1)
+    x2, y2 = max(x1 + 1, min(width, x2 + right)), max(y1 + 1, min(height, y2 + bottom))
+    return x1, y1, x2, y2
 
-        # Convert mel-spectrogram to torch tensor and send to device
-        mel = torch.FloatTensor(mel_spectrogram).unsqueeze(0).to(device)
+# Function to gather the mel window aligned with each video frame in one vectorized step.
+# Frames past the end of the audio get the last window.
+def mel_windows(window_view, sample_rate, fps, first_frame, num_frames):
+    mel_idx_multiplier = (sample_rate / MEL_HOP_LENGTH) / fps
+    starts = (np.arange(first_frame, first_frame + num_frames) * mel_idx_multiplier).astype(np.int64)
+    return window_view[np.minimum(starts, len(window_view) - 1)]
+
+# Function to pick how many frames go through the model in one forward pass
+def pick_batch_size(device, requested=None):
+    if requested:
+        return max(1, int(requested))
+    if device != 'cuda':
+        return DEFAULT_CPU_BATCH_SIZE
+    free_memory, _ = torch.cuda.mem_get_info()
+    return max(1, min(MAX_BATCH_SIZE, int(free_memory * 0.5) // BYTES_PER_SAMPLE))
+
+# Function to stack face crops and their mel windows into model-ready tensors
+def prepare_batch(crops, windows):
+    faces = np.stack(crops)
+
+    # Wav2Lip gets the face with its lower half masked plus the full reference face
+    masked = faces.copy()
+    masked[:, IMG_SIZE // 2:] = 0
+    faces = np.concatenate((masked, faces), axis=3).transpose(0, 3, 1, 2)
+    faces = torch.from_numpy(np.float32(faces) / 255.0)
+
+    mels = torch.from_numpy(np.ascontiguousarray(windows, dtype=np.float32)).unsqueeze(1)
+    return faces, mels
+
+# Function to copy a batch to the device, on a side stream when running on GPU
+def to_device(batch, device, stream=None):
+    faces, mels = batch
+    if stream is None:
+        return faces.to(device), mels.to(device)
+    with torch.cuda.stream(stream):
+        faces = faces.pin_memory().to(device, non_blocking=True)
+        mels = mels.pin_memory().to(device, non_blocking=True)
+    return faces, mels
+
+def run_batches(frames, windows, model, device, batch_size):
+    starts = range(0, len(frames), batch_size)
+    copy_stream = torch.cuda.Stream() if device == 'cuda' else None
+    outputs = []
+
+    # Copy the first batch, then always copy the next one while the current one runs
+    pending = None
+    if len(frames):
+        pending = to_device(prepare_batch(frames[:batch_size], windows[:batch_size]), device, copy_stream)
+
+    for start in starts:
+        faces, mels = pending
+        if copy_stream is not None:
+            # Wait for the copy and tell the allocator the compute stream uses these tensors
+            torch.cuda.current_stream().wait_stream(copy_stream)
+            faces.record_stream(torch.cuda.current_stream())
+            mels.record_stream(torch.cuda.current_stream())
+
+        next_start = start + batch_size
+        if next_start < len(frames):
+            next_batch = prepare_batch(frames[next_start:next_start + batch_size],
+                                       windows[next_start:next_start + batch_size])
+            pending = to_device(next_batch, device, copy_stream)
 
-        # Run the frame and mel-spectrogram through the Wav2Lip model
         with torch.no_grad():
-            output = model(mel, frame)
+            output = model(mels, faces)
+
+        # One device sync per batch instead of one per frame
+        output = output.cpu().numpy().transpose(0, 2, 3, 1)
+        outputs.extend(np.clip(output * 255, 0, 255).astype(np.uint8))
+
+    return outputs
 
-        # Post-process the output frame and convert it back to image format
-        output = output.squeeze().cpu().numpy().transpose(1, 2, 0)
-        output = np.clip(output * 255, 0, 255).astype(np.uint8)
-        synced_frames.append(output)
+def model_inference(frames, windows, model, device='cpu', batch_size=None):
+    batch_size = pick_batch_size(device, batch_size)
+    while True:
+        try:
+            return run_batches(frames, windows, model, device, batch_size)
+        except RuntimeError as e:
+            # Halve the batch when the GPU runs out of memory
+            if 'out of memory' not in str(e) or batch_size == 1:
+                raise
+            torch.cuda.empty_cache()
+            batch_size = max(1, batch_size // 2)
+            print(f"Out of memory, retrying with batch size {batch_size}")
 
-    return synced_frames
 # Function to sync the mouth movements in the video frames using the model
-def sync_mouth(frames, mel_spectrogram, model):
-    synced_frames = []
-    for frame in frames:
-        synced_frame = model_inference(frame, mel_spectrogram, model)
-        synced_frames.append(synced_frame)
-    return synced_frames
+# Frames are read lazily and synced chunk by chunk, so only one chunk is held at a time.
+# Only the face region of each frame goes through the model, as a 96x96 BGR crop, and
+# the synced face is scaled back and pasted into the full-resolution frame.
+def sync_mouth(frames, face_boxes, window_view, sample_rate, fps, model, device='cpu', batch_size=None,
+               chunk_size=CHUNK_SIZE, pads=FACE_PADS):
+    first_frame = 0
+    for chunk in chunked(frames, chunk_size):
+        windows = mel_windows(window_view, sample_rate, fps, first_frame, len(chunk))
+        regions = [face_region(face_boxes[min(first_frame + i, len(face_boxes) - 1)], frame.shape, pads)
+                   for i, frame in enumerate(chunk)]
+        crops = [cv2.resize(frame[y1:y2, x1:x2, ::-1], (IMG_SIZE, IMG_SIZE))
+                 for frame, (x1, y1, x2, y2) in zip(chunk, regions)]
+        faces = model_inference(crops, windows, model, device, batch_size)
+        for frame, (x1, y1, x2, y2), face in zip(chunk, regions, faces):
+            # Decoded frames are read-only
+            frame = frame.copy()
+            frame[y1:y2, x1:x2] = cv2.resize(face[..., ::-1], (x2 - x1, y2 - y1))
+            yield frame
+        first_frame += len(chunk)
 
 # Main handler for processing the video and audio synchronization
 def handler(job):
     job_input = job["input"]
+    timings = Timings(job, "lipSync_Wav2Lip")
     bucket_name = job_input["bucket_name"]
     video_input_key = job_input["video_input_key"]
     audio_input_key = job_input["audio_input_key"]
@@ -95,57 +294,98 @@ def handler(job):
     aws_secret_access_key = job_input["aws_secret_access_key"]
     aws_region = job_input["aws_region"]
     endpoint = job_input.get("endpoint", None)
+    batch_size = job_input.get("batch_size", None)  # Optional, picked from free memory otherwise
+    detect_every = max(1, int(job_input.get("detect_every", DEFAULT_DETECT_EVERY)))
+    pads = tuple(int(pad) for pad in job_input.get("face_pads", FACE_PADS))  # top, bottom, left, right
+    options = transfer_options(job_input)
 
-    # Setup AWS S3 client
-    os.environ['AWS_ACCESS_KEY_ID'] = aws_access_key_id
-    os.environ['AWS_SECRET_ACCESS_KEY'] = aws_secret_access_key
-    os.environ['AWS_DEFAULT_REGION'] = aws_region
-    s3 = boto3.client('s3', endpoint_url=endpoint)
+    # Reuse a pooled S3 client for these credentials and endpoint
+    s3 = get_s3_client(aws_access_key_id, aws_secret_access_key, aws_region, endpoint)
+
+    # Answer repeated work from the result cache without loading any model
+    with timings.span("cache_lookup"):
+        cache_key, cached_url = check_result_cache(s3, job_input, output_key, "lipSync_Wav2Lip", "wav2lip",
+                                                   ("video_input_key", "audio_input_key"))
+    if cached_url is not None:
+        return {"video_url": cached_url, "cache_hit": True, "timings": timings.report()}
 
     with tempfile.TemporaryDirectory() as tmpdir:
         video_path = os.path.join(tmpdir, "input_video.mp4")
         audio_path = os.path.join(tmpdir, "input_audio.wav")
-        output_video_path = os.path.join(tmpdir, "output_video.mp4")
         final_output_path = os.path.join(tmpdir, "final_output.mp4")
 
-        # Download video and audio from S3
-        video_response = s3.get_object(Bucket=bucket_name, Key=video_input_key)
-        audio_response = s3.get_object(Bucket=bucket_name, Key=audio_input_key)
-
-        with open(video_path, "wb") as f:
-            f.write(video_response['Body'].read())
-        with open(audio_path, "wb") as f:
-            f.write(audio_response['Body'].read())
+        # Stream video and audio from S3 straight to disk with parallel ranged GETs
+        with timings.span("s3_download"):
+            transfers = [
+                download_file(s3, bucket_name, video_input_key, video_path, **options),
+                download_file(s3, bucket_name, audio_input_key, audio_path, **options),
+            ]
 
-        # Load the model and process the files
-        model = load_model_from_pth(wav2lip_model_path)
+        # Load the model once per worker and move it to the device a single time
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        model = model.to(device).eval()
+        model, _ = timings.load_resident("wav2lip", lambda: load_model().to(device))
+
+        # Face boxes for every frame, detected once per input video
+        box_key = (s3.head_object(Bucket=bucket_name, Key=video_input_key)["ETag"].strip('"'), detect_every)
+        face_boxes = face_box_cache.get(box_key)
+        face_cache_hit = face_boxes is not None
+        if not face_cache_hit:
+            detector, _ = timings.load_resident("s3fd", lambda: load_detector(device))
+            with timings.span("face_detection"):
+                frame_count, indices, boxes = detect_faces(detector, video_path, detect_every)
+                face_boxes = track_faces(frame_count, indices, boxes)
+            face_box_cache.put(box_key, face_boxes)
 
-        video_clip = VideoFileClip(video_path)
-        audio_clip, sample_rate = librosa.load(audio_path, sr=16000)
+        with timings.span("decode"):
+            video_clip = VideoFileClip(video_path)
 
-        frames = [frame for frame in video_clip.iter_frames()]
-        mel_spectrogram = preprocess_mel(audio_clip, sample_rate)
+        # Mel spectrogram of the audio, computed once per distinct audio file
+        sample_rate = AUDIO_SAMPLE_RATE
+        with timings.span("preprocess"):
+            audio_hash = sha256_file(audio_path)
+            mel = mel_cache.get(audio_hash)
+        mel_cache_hit = mel is not None
+        if not mel_cache_hit:
+            with timings.span("decode"):
+                audio_clip, _ = librosa.load(audio_path, sr=sample_rate)
+            with timings.span("preprocess"):
+                mel = preprocess_mel(audio_clip)
+            mel_cache.put(audio_hash, mel)
 
-        synced_frames = sync_mouth(frames, mel_spectrogram, model)
+        # Decode the next frames on a background thread while the current chunk is synced
+        frames = prefetch(video_clip.iter_frames(), depth=PREFETCH_FRAMES)
+        synced_frames = sync_mouth(frames, face_boxes, mel_window_view(mel), sample_rate, video_clip.fps, model,
+                                   device, batch_size, pads=pads)
 
-        # Write the output video
-        height, width, _ = synced_frames[0].shape
-        out = cv2.VideoWriter(output_video_path, cv2.VideoWriter_fourcc(*'mp4v'), video_clip.fps, (width, height))
-        for frame in synced_frames:
-            out.write(frame)
-        out.release()
+        # Stream the synced frames into one ffmpeg process that also muxes the audio.
+        # Inference runs lazily as frames are pulled, so it is timed around each pull.
+        with VideoWriter(final_output_path, video_clip.fps, audio_path=audio_path) as out:
+            while True:
+                with timings.span("inference"):
+                    frame = next(synced_frames, None)
+                if frame is None:
+                    break
+                with timings.span("encode"):
+                    out.write(frame)
+        video_clip.close()
 
-        # Combine video and audio and upload to S3
-        subprocess.run(['ffmpeg', '-y', '-i', output_video_path, '-i', audio_path, '-c:v', 'copy', '-c:a', 'aac', final_output_path])
-        with open(final_output_path, "rb") as f:
-            s3.put_object(Bucket=bucket_name, Key=output_key, Body=f, ContentType='video/mp4')
+        # Upload to S3 in concurrent multipart parts
+        with timings.span("s3_upload"):
+            transfers.append(upload_file(s3, bucket_name, output_key, final_output_path, 'video/mp4', **options))
+            store_result(s3, cache_key, bucket_name, output_key)
 
-        response = s3.generate_presigned_url('get_object',
-                                             Params={'Bucket': bucket_name,
-                                                     'Key': output_key}, ExpiresIn=3600)
-    return response
+        with timings.span("presign"):
+            response = s3.generate_presigned_url('get_object',
+                                                 Params={'Bucket': bucket_name,
+                                                         'Key': output_key}, ExpiresIn=3600)
+    return {
+        "video_url": response,
+        "transfers": transfers,
+        "cache_hit": False,
+        "face_cache_hit": face_cache_hit,
+        "mel_cache_hit": mel_cache_hit,
+        "timings": timings.report()
+    }
 
 # Start the Runpod serverless handler
 runpod.serverless.start({"handler": handler})
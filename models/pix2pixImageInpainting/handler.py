@@ -1,10 +1,36 @@
-import PIL
-import requests
+import io
+import os
+import sys
+import runpod
 import torch
+from PIL import Image, ImageOps
 from diffusers import StableDiffusionInstructPix2PixPipeline, EulerAncestralDiscreteScheduler
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.assets import ModelAssets
+from common.encode import image_format, upload_image
+from common.concurrency import async_handler, concurrency_modifier, inference_slot
+from common.residency import model_state
+from common.result_cache import check_result_cache, store_result
+from common.s3 import get_s3_client
+from common.timing import Timings
+
+# Weights listed in assets.json, baked into the image at build time
+assets = ModelAssets(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Load the Stable Diffusion Instruct Pix2Pix pipeline
+def load_pipeline():
+    model_id = assets.repo("timbrooks/instruct-pix2pix")
+    pipe = StableDiffusionInstructPix2PixPipeline.from_pretrained(model_id, torch_dtype=torch.float16, safety_checker=None)
+    pipe.to("cuda")
+    pipe.scheduler = EulerAncestralDiscreteScheduler.from_config(pipe.scheduler.config)
+    return pipe
+
+
 def handler(job):
     job_input = job["input"]  # Access the input from the request.
+    timings = Timings(job, "pix2pixImageInpainting")
     bucket_name = job_input["bucket_name"]
     input_key = job_input["input_key"]
     output_key = job_input["output_key"]
@@ -13,43 +39,47 @@ def handler(job):
     aws_region = job_input["aws_region"]
     hf_prompt = job_input["hf_prompt"]  # Text prompt for hugging face model
     endpoint = job_input.get("endpoint", None)  # Optional custom endpoint URL
+    output_format = image_format(job_input)  # Optional output_format / output_quality, PNG by default
 
-    # Set AWS credentials and region
-    os.environ['AWS_ACCESS_KEY_ID'] = aws_access_key_id
-    os.environ['AWS_SECRET_ACCESS_KEY'] = aws_secret_access_key
-    os.environ['AWS_DEFAULT_REGION'] = aws_region
+    # Reuse a pooled S3 client for these credentials and endpoint
+    s3 = get_s3_client(aws_access_key_id, aws_secret_access_key, aws_region, endpoint)
 
-    # Initialize S3 client with a custom endpoint if provided
-    s3 = boto3.client('s3', endpoint_url=endpoint)
+    # Answer repeated work from the result cache without loading any model
+    with timings.span("cache_lookup"):
+        cache_key, cached_url = check_result_cache(s3, job_input, output_key, "pix2pixImageInpainting", "timbrooks/instruct-pix2pix")
+    if cached_url is not None:
+        return {"image_url": cached_url, "cache_hit": True, "timings": timings.report()}
 
     # Load the image from S3
-    response = s3.get_object(Bucket=bucket_name, Key=input_key)
-    image_data = response['Body'].read()
-    image = ImageOps.exif_transpose(image)
-    image = image.convert("RGB") # Convert to RGB
+    with timings.span("s3_download"):
+        response = s3.get_object(Bucket=bucket_name, Key=input_key)
+        image_data = response['Body'].read()
+    with timings.span("decode"):
+        image = Image.open(io.BytesIO(image_data))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB") # Convert to RGB
 
-    # Load the Stable Diffusion Instruct Pix2Pix pipeline
-    model_id = "timbrooks/instruct-pix2pix"
-    pipe = StableDiffusionInstructPix2PixPipeline.from_pretrained(model_id, torch_dtype=torch.float16, safety_checker=None)
-    pipe.to("cuda")
-    pipe.scheduler = EulerAncestralDiscreteScheduler.from_config(pipe.scheduler.config)
+    # Reuse the pipeline kept by this worker, loading it on the first job only
+    pipe, warm = timings.load_resident("instruct-pix2pix", load_pipeline)
 
-    # Generate the image based on the prompt
-    images = pipe(hf_prompt, image=image, num_inference_steps=10, image_guidance_scale=1).images
+    # Generate the image based on the prompt, one job at a time on the pipeline
+    with inference_slot("instruct-pix2pix"), timings.span("inference"):
+        images = pipe(hf_prompt, image=image, num_inference_steps=10, image_guidance_scale=1).images
     result_image = images[0]
 
-    # Save the result image to a BytesIO buffer
-    buffer = io.BytesIO()
-    result_image.save(buffer, format="PNG")
-    buffer.seek(0)
-
     # Upload the result image to S3
-    s3.put_object(Bucket=bucket_name, Key=output_key, Body=buffer, ContentType='image/png')
+    response, encoded = upload_image(s3, bucket_name, output_key, result_image, output_format, timings)
+    store_result(s3, cache_key, bucket_name, output_key)
 
-    # Return presigned URL for the output image
-    response = s3.generate_presigned_url('get_object',
-                                         Params={'Bucket': bucket_name,
-                                                 'Key': output_key}, ExpiresIn=3600)
-    return response
+    return {
+        "image_url": response,
+        "model_state": model_state(warm),
+        "cache_hit": False,
+        "encoding": encoded,
+        "timings": timings.report()
+    }
 
-runpod.serverless.start({"handler": handler}) # Required.
\ No newline at end of file
+# Several jobs run at once so S3 transfers and encoding overlap with inference.
+# Not when imported by the diffusersMultiTask worker, which serves this handler among others.
+if __name__ == "__main__":
+    runpod.serverless.start({"handler": async_handler(handler), "concurrency_modifier": concurrency_modifier}) # Required.
\ No newline at end of file
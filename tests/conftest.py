@@ -0,0 +1,31 @@
+import os
+import sys
+
+import boto3
+import pytest
+from moto import mock_aws
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models")
+sys.path.insert(0, MODELS_DIR)
+
+BUCKET = "tests"
+REGION = "us-east-1"
+
+# Credentials for moto, never sent anywhere
+CREDENTIALS = {"aws_access_key_id": "testing", "aws_secret_access_key": "testing", "aws_region": REGION}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """
+    A client for moto's in-process S3 stand-in, with an empty bucket.
+    """
+    from common.s3 import clear_s3_clients
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(name, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", REGION)
+    with mock_aws():
+        client = boto3.client("s3", region_name=REGION)
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+    clear_s3_clients()
@@ -0,0 +1,32 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from common.encode import PNGWriter
+
+
+def test_png_writer_round_trips_through_pil():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(37, 53, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+
+    # A small chunk size spreads the image data over several IDAT chunks
+    writer = PNGWriter(buffer, 53, 37, compress_level=1, chunk_size=256)
+    for start in range(0, 37, 10):
+        writer.write_rows(image[start:start + 10])
+    writer.close()
+
+    decoded = Image.open(io.BytesIO(buffer.getvalue()))
+    assert decoded.format == "PNG" and decoded.mode == "RGB"
+    assert np.array_equal(np.asarray(decoded), image)
+
+
+def test_png_writer_checks_row_count():
+    writer = PNGWriter(io.BytesIO(), 4, 4)
+    writer.write_rows(np.zeros((3, 4, 3), dtype=np.uint8))
+    with pytest.raises(ValueError):
+        writer.close()
+    with pytest.raises(ValueError):
+        writer.write_rows(np.zeros((1, 5, 3), dtype=np.uint8))
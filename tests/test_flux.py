@@ -0,0 +1,162 @@
+import importlib.util
+import io
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+from conftest import BUCKET, CREDENTIALS, MODELS_DIR
+
+
+def image_bytes(color, fmt):
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), color).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+class InferenceAPI(ThreadingHTTPServer):
+    """
+    Local stand-in for the inference API. `statuses` are answered first, one
+    per request, then every request gets `image` (or the result of `respond`).
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), InferenceRequest)
+        self.statuses = []
+        self.image = image_bytes("red", "PNG")
+        self.respond = None
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/models/flux"
+
+
+class InferenceRequest(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            self.server.requests.append((self.headers["Authorization"], body["inputs"]))
+            status = self.server.statuses.pop(0) if self.server.statuses else 200
+        content = b'{"error": "busy"}' if status != 200 else (
+            self.server.respond(body["inputs"]) if self.server.respond else self.server.image)
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api():
+    server = InferenceAPI()
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def flux(api, monkeypatch):
+    """
+    models/fluxImageGeneration/handler.py, pointed at the local API and with
+    runpod.serverless.start turned into a no-op.
+    """
+    import runpod
+    monkeypatch.setattr(runpod.serverless, "start", lambda config: None)
+    monkeypatch.setenv("HF_API_URL", api.url)
+    path = os.path.join(MODELS_DIR, "fluxImageGeneration", "handler.py")
+    spec = importlib.util.spec_from_file_location("flux_handler", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run(flux, **fields):
+    return flux.handler({"id": "test", "input": dict(bucket_name=BUCKET, hf_auth_token="token", use_cache=False,
+                                                     **CREDENTIALS, **fields)})
+
+
+def stored(s3, key):
+    response = s3.get_object(Bucket=BUCKET, Key=key)
+    return response["Body"].read(), response["ContentType"]
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_retries_through_the_shared_session(s3, api, flux, status):
+    api.statuses = [status]
+    output = run(flux, hf_prompt="a lighthouse", output_key="out.png")
+
+    assert len(api.requests) == 2
+    assert api.requests[0] == ("Bearer token", "a lighthouse")
+    assert stored(s3, "out.png")[0] == api.image
+    assert output["cache_hit"] is False
+
+
+def test_gives_up_after_the_retry_budget(s3, api, flux):
+    import requests
+    flux.session.get_adapter(api.url).max_retries.backoff_factor = 0
+    api.statuses = [503] * 10
+    with pytest.raises(requests.exceptions.RetryError):
+        run(flux, hf_prompt="a lighthouse", output_key="out.png")
+    # The first attempt and five retries
+    assert len(api.requests) == 6
+
+
+@pytest.mark.parametrize("fmt, content_type", [("PNG", "image/png"), ("JPEG", "image/jpeg")])
+def test_upstream_bytes_are_stored_as_returned(s3, api, flux, fmt, content_type):
+    api.image = image_bytes("blue", fmt)
+    output = run(flux, hf_prompt="a lighthouse", output_key="out")
+
+    assert stored(s3, "out") == (api.image, content_type)
+    assert output["encoding"] == {"format": fmt.lower(), "bytes": len(api.image)}
+    assert "encode" not in output["timings"]["stages"]
+
+
+def test_requested_format_is_transcoded(s3, api, flux):
+    output = run(flux, hf_prompt="a lighthouse", output_key="out.webp", output_format="webp")
+
+    data, content_type = stored(s3, "out.webp")
+    assert content_type == "image/webp"
+    assert Image.open(io.BytesIO(data)).format == "WEBP"
+    assert output["encoding"]["format"] == "webp"
+
+
+def test_prompts_fan_out(s3, api, flux):
+    prompts = [f"a lighthouse, take {i}" for i in range(3)]
+    colors = dict(zip(prompts, ["red", "green", "blue"]))
+
+    # Every request waits until all prompts are in flight, so this only passes when they are sent concurrently
+    barrier = threading.Barrier(len(prompts), timeout=10)
+
+    def respond(prompt):
+        barrier.wait()
+        return image_bytes(colors[prompt], "PNG")
+
+    api.respond = respond
+    output = run(flux, hf_prompts=prompts, output_keys=[f"out/{i}.png" for i in range(3)])
+
+    assert sorted(prompt for _, prompt in api.requests) == prompts
+    assert [image["prompt"] for image in output["images"]] == prompts
+    for i, image in enumerate(output["images"]):
+        assert image["output_key"] == f"out/{i}.png"
+        assert stored(s3, image["output_key"])[0] == image_bytes(colors[prompts[i]], "PNG")
+
+
+def test_prompts_and_keys_must_match(s3, flux):
+    with pytest.raises(ValueError):
+        run(flux, hf_prompts=["a", "b"], output_keys=["out.png"])
+
+
+def test_pool_covers_every_concurrent_request(flux):
+    adapter = flux.session.get_adapter(flux.API_URL)
+    assert adapter._pool_maxsize == flux.JOB_CONCURRENCY * flux.MAX_CONCURRENT_REQUESTS
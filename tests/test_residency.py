@@ -0,0 +1,17 @@
+import sys
+
+from common import residency
+
+
+def test_workers_without_torch(monkeypatch):
+    # dentro_faceswap's image has onnxruntime models and no torch
+    monkeypatch.setitem(sys.modules, "torch", None)
+    monkeypatch.setattr(residency, "DEVICE_BUDGET_MB", 1024)
+    models = (object(), object())
+
+    with residency.job_scope():
+        model, warm = residency.load_resident("no-torch", lambda: models)
+    assert model is models and not warm
+    assert residency.load_resident("no-torch", lambda: None) == (models, True)
+    assert residency.device_type() == "cpu"
+    assert residency.residency_stats()["device_mb"] == 0
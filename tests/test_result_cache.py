@@ -0,0 +1,26 @@
+from common.result_cache import ResultCache, check_result_cache, store_result
+from conftest import BUCKET
+
+
+def test_jobs_without_use_cache_skip_the_cache(s3):
+    s3.put_object(Bucket=BUCKET, Key="in.png", Body=b"input")
+    job_input = {"bucket_name": BUCKET, "input_key": "in.png"}
+
+    assert check_result_cache(s3, job_input, "out.png", "handler", "model") == (None, None)
+    store_result(s3, None, BUCKET, "out.png")
+    assert s3.list_objects_v2(Bucket=BUCKET)["KeyCount"] == 1
+
+
+def test_index_objects_are_shared_between_workers(s3):
+    s3.put_object(Bucket=BUCKET, Key="in.png", Body=b"input")
+    s3.put_object(Bucket=BUCKET, Key="out.png", Body=b"output")
+    job_input = {"bucket_name": BUCKET, "input_key": "in.png", "use_cache": True}
+    first, second = ResultCache(prefix="result-cache/"), ResultCache(prefix="result-cache/")
+
+    cache_key = first.key(s3, job_input, "handler", "model")
+    assert first.lookup(s3, cache_key, BUCKET, "out.png") is None
+    first.store(s3, cache_key, BUCKET, "out.png")
+
+    assert second.lookup(s3, cache_key, BUCKET, "copy.png") is not None
+    assert s3.get_object(Bucket=BUCKET, Key="copy.png")["Body"].read() == b"output"
+    assert second.stats() == {"entries": 1, "hits": 1, "index_hits": 1, "misses": 0}
@@ -0,0 +1,103 @@
+import os
+import threading
+
+import pytest
+
+from common.transfer import DEFAULT_CONCURRENCY, DEFAULT_PART_SIZE_MB, download_file, transfer_options, upload_file
+from conftest import BUCKET
+
+MB = 1024 * 1024
+
+# S3 parts must be at least 5 MB, so this object spans three of them
+PART_SIZE_MB = 5
+OBJECT_SIZE = 12 * MB
+
+
+@pytest.fixture
+def payload(tmp_path):
+    path = tmp_path / "payload.bin"
+    path.write_bytes(os.urandom(OBJECT_SIZE))
+    return str(path)
+
+
+def record_calls(s3, operation):
+    """
+    Record the parameters and thread of every `operation` call made by the client.
+    """
+    calls = []
+
+    def record(params, **kwargs):
+        calls.append((params, threading.current_thread()))
+
+    s3.meta.events.register(f"before-parameter-build.s3.{operation}", record)
+    return calls
+
+
+def test_transfer_options_defaults():
+    assert transfer_options({}) == {"part_size_mb": DEFAULT_PART_SIZE_MB, "concurrency": DEFAULT_CONCURRENCY}
+
+
+def test_transfer_options_overrides():
+    options = transfer_options({"transfer_part_size_mb": "8", "transfer_concurrency": 2})
+    assert options == {"part_size_mb": 8, "concurrency": 2}
+
+
+def test_upload_is_multipart(s3, payload):
+    parts = record_calls(s3, "UploadPart")
+    upload_file(s3, BUCKET, "video.mp4", payload, "video/mp4", part_size_mb=PART_SIZE_MB, concurrency=4)
+
+    assert len(parts) == 3
+    head = s3.head_object(Bucket=BUCKET, Key="video.mp4")
+    assert head["ContentLength"] == OBJECT_SIZE
+    assert head["ContentType"] == "video/mp4"
+    assert head["ETag"].strip('"').endswith("-3")
+
+
+def test_upload_part_size_override(s3, payload):
+    parts = record_calls(s3, "UploadPart")
+    upload_file(s3, BUCKET, "video.mp4", payload, "video/mp4", part_size_mb=8, concurrency=4)
+    assert len(parts) == 2
+
+
+def test_download_uses_ranged_gets(s3, payload, tmp_path):
+    s3.upload_file(payload, BUCKET, "video.mp4")
+    gets = record_calls(s3, "GetObject")
+    target = str(tmp_path / "downloaded.bin")
+    download_file(s3, BUCKET, "video.mp4", target, part_size_mb=PART_SIZE_MB, concurrency=4)
+
+    # One ranged GET per part; the last range may be left open-ended
+    starts = sorted(int(params["Range"].split("=")[1].split("-")[0]) for params, _ in gets)
+    assert starts == [0, 5 * MB, 10 * MB]
+    with open(payload, "rb") as expected, open(target, "rb") as downloaded:
+        assert downloaded.read() == expected.read()
+
+
+def test_single_concurrency_stays_on_the_calling_thread(s3, payload, tmp_path):
+    s3.upload_file(payload, BUCKET, "video.mp4")
+    gets = record_calls(s3, "GetObject")
+    download_file(s3, BUCKET, "video.mp4", str(tmp_path / "downloaded.bin"), part_size_mb=PART_SIZE_MB,
+                  concurrency=1)
+    assert len(gets) == 3
+    assert {thread for _, thread in gets} == {threading.current_thread()}
+
+
+def test_small_object_is_a_single_request(s3, tmp_path):
+    path = tmp_path / "small.bin"
+    path.write_bytes(b"x" * 1024)
+    parts = record_calls(s3, "UploadPart")
+    upload_file(s3, BUCKET, "small.bin", str(path), "application/octet-stream", part_size_mb=PART_SIZE_MB)
+    assert parts == []
+
+
+def test_stats(s3, payload, tmp_path):
+    upload = upload_file(s3, BUCKET, "video.mp4", payload, "video/mp4", part_size_mb=PART_SIZE_MB)
+    download = download_file(s3, BUCKET, "video.mp4", str(tmp_path / "downloaded.bin"),
+                             part_size_mb=PART_SIZE_MB)
+
+    for stats, direction in ((upload, "upload"), (download, "download")):
+        assert set(stats) == {"direction", "key", "bytes", "seconds", "mb_per_s"}
+        assert stats["direction"] == direction
+        assert stats["key"] == "video.mp4"
+        assert stats["bytes"] == OBJECT_SIZE
+        assert stats["seconds"] >= 0
+        assert stats["mb_per_s"] is None or stats["mb_per_s"] > 0